@@ -14,8 +14,13 @@ from bison.errors import SchemeValidationError
 from nio import InviteMemberEvent, JoinResponse, MegolmEvent, RoomMessageText, UnknownEvent, RoomMessageImage
 
 from matrix_gpt import MatrixClientHelper
+from matrix_gpt.api_client_manager import api_client_helper
 from matrix_gpt.callbacks import MatrixBotCallbacks
 from matrix_gpt.config import global_config
+from matrix_gpt.image import shutdown_executor
+from matrix_gpt.metrics import metrics
+from matrix_gpt.retry import retry_after, retry_delay, retry_matrix
+from matrix_gpt.scheduler import request_scheduler
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -24,6 +29,7 @@ logger = logging.getLogger('MatrixGPT')
 
 
 async def main(args):
+    start = time.monotonic()
     args.config = Path(args.config)
     if not args.config.exists():
         logger.critical('Config file does not exist:', args.config)
@@ -81,6 +87,10 @@ async def main(args):
     if global_config['openai'].get('api_base'):
         logger.info(f'Set OpenAI API base URL to: {global_config["openai"].get("api_base")}')
 
+    metrics_task = None
+    if global_config['logging']['metrics_interval'] > 0:
+        metrics_task = asyncio.create_task(metrics.log_forever(global_config['logging']['metrics_interval']))
+
     # Set up event callbacks
     callbacks = MatrixBotCallbacks(client=client_helper)
     client.add_event_callback(callbacks.handle_message, (RoomMessageText, RoomMessageImage))
@@ -88,51 +98,80 @@ async def main(args):
     client.add_event_callback(callbacks.decryption_failure, MegolmEvent)
     client.add_event_callback(callbacks.unknown, UnknownEvent)
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            logger.info('Logging in...')
-            while True:
-                login_success, login_response = await client_helper.login()
-                if not login_success:
-                    if 'M_LIMIT_EXCEEDED' in str(login_response):
-                        try:
-                            wait = int((int(str(login_response).split(' ')[-1][:-2]) / 1000) / 2)  # only wait half the ratelimited time
-                            logger.error(f'Ratelimited, sleeping {wait}s...')
-                            time.sleep(wait)
-                        except:
-                            logger.error(f'Could not parse M_LIMIT_EXCEEDED: {login_response}')
+    # Stop the same way on SIGTERM (like from systemd) as on Ctrl-C, by cancelling this task so the shutdown below runs.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    try:
+        # Keep trying to reconnect on failure (with some time in-between)
+        first_sync = True
+        reconnect_attempt = 0
+        while True:
+            try:
+                logger.info('Logging in...')
+                login_attempt = 0
+                while True:
+                    login_success, login_response = await client_helper.login()
+                    if not login_success:
+                        delay = retry_delay(login_attempt, base=5, max_delay=300, response=login_response)
+                        if retry_after(login_response) is not None:
+                            logger.error(f'Ratelimited, sleeping {round(delay, 2)}s...')
+                        else:
+                            logger.error(f'Failed to login, retrying in {round(delay, 2)}s: {login_response}')
+                        await asyncio.sleep(delay)
+                        login_attempt += 1
                     else:
-                        logger.error(f'Failed to login, retrying: {login_response}')
-                        time.sleep(5)
+                        break
+
+                # Login succeeded!
+                logger.info(f'Logged in as {client.user_id}')
+                if global_config.get('autojoin_rooms'):
+                    for room in global_config.get('autojoin_rooms'):
+                        r = await retry_matrix(lambda: client.join(room), attempts=3, base=1.5, description=f'Joining room {room}')
+                        if not isinstance(r, JoinResponse):
+                            logger.critical(f'Failed to join room {room}: {vars(r)}')
+
+                logger.info('Performing initial sync...')
+                if not first_sync:
+                    # Reconnecting, get what we missed.
+                    last_sync = (await client_helper.sync()).next_batch
+                elif global_config['sync']['startup_mode'] == 'catchup' and client_helper.state.sync_token_ts:
+                    callbacks.start_catchup(client_helper.state.sync_token_ts)
+                    last_sync = (await client_helper.sync(timeline_limit=global_config['sync']['catchup_timeline_limit'])).next_batch
+                    request_scheduler.spawn(callbacks.finish_catchup(time.monotonic()))
                 else:
-                    break
-
-            # Login succeeded!
-            logger.info(f'Logged in as {client.user_id}')
-            if global_config.get('autojoin_rooms'):
-                for room in global_config.get('autojoin_rooms'):
-                    r = await client.join(room)
-                    if not isinstance(r, JoinResponse):
-                        logger.critical(f'Failed to join room {room}: {vars(r)}')
-                    time.sleep(1.5)
-
-            logger.info('Performing initial sync...')
-            last_sync = (await client_helper.sync()).next_batch
-            client_helper.run_sync_in_bg()  # start a background thread to record our sync tokens
-
-            logger.info('Bot is active')
-            await client.sync_forever(timeout=10000, full_state=True, since=last_sync)
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-            time.sleep(15)
-        except KeyboardInterrupt:
-            await client.close()
-            os.kill(os.getpid(), signal.SIGTERM)
+                    # Skip the backlog.
+                    last_sync = (await client_helper.sync(timeline_limit=0)).next_batch
+                client_helper.start_sync_checkpointing()  # record our sync tokens as sync_forever() runs
+
+                reconnect_attempt = 0
+                if first_sync:
+                    logger.info(f'Bot is active, ready in {round(time.monotonic() - start, 2)}s')
+                    first_sync = False
+                else:
+                    logger.info('Bot is active')
+                await client.sync_forever(timeout=10000, full_state=global_config['sync']['full_state'], since=last_sync, sync_filter=client_helper.sync_filter())
+            except (ClientConnectionError, ServerDisconnectedError):
+                delay = retry_delay(reconnect_attempt, base=15, max_delay=300)
+                logger.warning(f"Unable to connect to homeserver, retrying in {round(delay, 2)}s...")
+                await asyncio.sleep(delay)
+                reconnect_attempt += 1
+            except Exception:
+                logger.critical(traceback.format_exc())
+                delay = retry_delay(reconnect_attempt, base=5, max_delay=300)
+                logger.critical(f'Sleeping {round(delay, 2)}s...')
+                await asyncio.sleep(delay)
+                reconnect_attempt += 1
+    finally:
+        if metrics_task:
+            metrics_task.cancel()
+        client_helper.save_sync_token()
+        try:
+            await client_helper.state.flush()
         except Exception:
-            logger.critical(traceback.format_exc())
-            logger.critical('Sleeping 5s...')
-            time.sleep(5)
+            logger.critical(f'Failed to save the bot state: {traceback.format_exc()}')
+        await client.close()
+        await api_client_helper.close()
+        shutdown_executor()
 
 
 if __name__ == "__main__":
@@ -143,7 +182,7 @@ if __name__ == "__main__":
     while True:
         try:
             asyncio.run(main(args))
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
             os.kill(os.getpid(), signal.SIGTERM)
         except Exception:
             logger.critical(traceback.format_exc())
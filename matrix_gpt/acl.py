@@ -0,0 +1,61 @@
+import logging
+from typing import Dict, Iterable, Tuple
+
+logger = logging.getLogger('MatrixGPT').getChild('ACL')
+
+# How many (sender, ACL) decisions to remember before starting over.
+MAX_DECISIONS = 10000
+
+
+class Acl:
+    """
+    A compiled access list. Entries are `all`, a full user ID (`@user:example.com`), or a homeserver (`example.com`).
+    """
+    __slots__ = ('allow_all', 'users', 'homeservers')
+
+    def __init__(self, entries: Iterable[str]):
+        entries = [e.strip() for e in entries]
+        self.allow_all = 'all' in entries
+        self.users = frozenset(e for e in entries if '@' in e or ':' in e)
+        self.homeservers = frozenset(e for e in entries if e != 'all' and '@' not in e and ':' not in e)
+
+    def allows(self, user_id: str) -> bool:
+        return self.allow_all or user_id in self.users or user_id.split(':', 1)[-1] in self.homeservers
+
+    def __repr__(self):
+        return f'<Acl all={self.allow_all} users={sorted(self.users)} homeservers={sorted(self.homeservers)}>'
+
+
+_compiled: Dict[Tuple[str, ...], Acl] = {}
+_decisions: Dict[Tuple[str, Acl], bool] = {}
+
+
+def compile_acl(entries: str | Iterable[str] | Acl) -> Acl:
+    """
+    Get the compiled ACL for a list of entries (or a single entry). The same entries always give the same `Acl` object.
+    """
+    if isinstance(entries, Acl):
+        return entries
+    key = (entries,) if isinstance(entries, str) else tuple(entries)
+    acl = _compiled.get(key)
+    if acl is None:
+        acl = _compiled[key] = Acl(key)
+    return acl
+
+
+def is_allowed(user_id: str, acl: Acl) -> bool:
+    key = (user_id, acl)
+    decision = _decisions.get(key)
+    if decision is None:
+        if len(_decisions) >= MAX_DECISIONS:
+            _decisions.clear()
+        decision = _decisions[key] = acl.allows(user_id)
+    return decision
+
+
+def clear_acl_cache():
+    """
+    Forget all compiled ACLs and decisions. Called when the config is (re)loaded.
+    """
+    _compiled.clear()
+    _decisions.clear()
@@ -1,10 +1,12 @@
 import logging
 
+import httpx
 from nio import MatrixRoom, Event
 
 from matrix_gpt import MatrixClientHelper
 from matrix_gpt.config import global_config
 from matrix_gpt.generate_clients.anthropic import AnthropicApiClient
+from matrix_gpt.generate_clients.command_info import CommandInfo
 from matrix_gpt.generate_clients.copilot import CopilotClient
 from matrix_gpt.generate_clients.openai import OpenAIClient
 
@@ -18,6 +20,7 @@ class ApiClientManager:
         self._openai_api_key = None
         self._openai_api_base = None
         self._anth_api_key = None
+        self._sdk_clients = {}
         self.logger = logging.getLogger('MatrixGPT').getChild('ApiClientManager')
 
     def _set_from_config(self):
@@ -28,9 +31,42 @@ class ApiClientManager:
         self._anth_api_key = global_config['anthropic'].get('api_key')
         self._copilot_cookie = global_config['copilot'].get('api_key')
 
-    def get_client(self, mode: str, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event):
+    def get_sdk_client(self, api_type: str, api_key: str, api_base: str | None, factory):
+        """
+        Get the long-lived provider SDK client for this API type, key, and base URL, creating it with `factory` if it doesn't exist yet.
+        All `ApiClient` instances share these so that connections to the provider are kept alive between requests.
+        """
+        key = (api_type, api_key, api_base)
+        client = self._sdk_clients.get(key)
+        if client is None:
+            client = factory(self._create_http_client())
+            self._sdk_clients[key] = client
+            self.logger.debug(f'Created {api_type} client for {api_base if api_base else "the default API base"}')
+        return client
+
+    @staticmethod
+    def _create_http_client() -> httpx.AsyncClient:
+        limits = global_config['api_clients']
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=limits['max_connections'],
+                max_keepalive_connections=limits['max_keepalive_connections'],
+                keepalive_expiry=limits['keepalive_expiry']
+            ),
+            follow_redirects=True
+        )
+
+    async def close(self):
+        """
+        Close the shared provider clients and their connection pools.
+        """
+        for client in self._sdk_clients.values():
+            await client.close()
+        self._sdk_clients.clear()
+
+    def get_client(self, mode: str, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event, command_info: CommandInfo = None):
         if mode == 'openai':
-            return self.openai_client(client_helper, room, event)
+            return self.openai_client(client_helper, room, event, command_info)
         elif mode == 'anthropic':
             return self.anth_client(client_helper, room, event)
         elif mode == 'copilot':
@@ -38,16 +74,18 @@ class ApiClientManager:
         else:
             raise Exception
 
-    def openai_client(self, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event):
+    def openai_client(self, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event, command_info: CommandInfo = None):
         self._set_from_config()
-        if not self._openai_api_key:
+        # Commands with a pool of endpoints use the endpoints' keys, or none at all for self-hosted servers.
+        if not self._openai_api_key and not (command_info and command_info.endpoints):
             self.logger.error('Missing an OpenAI API key!')
             return None
         return OpenAIClient(
             api_key=self._openai_api_key,
             client_helper=client_helper,
             room=room,
-            event=event
+            event=event,
+            client_manager=self
         )
 
     def anth_client(self, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event):
@@ -59,7 +97,8 @@ class ApiClientManager:
             api_key=self._anth_api_key,
             client_helper=client_helper,
             room=room,
-            event=event
+            event=event,
+            client_manager=self
         )
 
     def copilot_client(self, client_helper, room: MatrixRoom, event: Event):
@@ -71,7 +110,8 @@ class ApiClientManager:
             api_key=self._copilot_cookie,
             client_helper=client_helper,
             room=room,
-            event=event
+            event=event,
+            client_manager=self
         )
 
 
@@ -1,10 +1,118 @@
-from matrix_gpt import MatrixClientHelper
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Set
 
+from nio import AsyncClient
 
-def background(client_helper: MatrixClientHelper):
+logger = logging.getLogger('MatrixGPT').getChild('TypingManager')
+read_marker_logger = logging.getLogger('MatrixGPT').getChild('ReadMarkerManager')
+
+# How long the homeserver shows us as typing for, and how often we refresh it.
+TYPING_TIMEOUT_MS = 30000
+TYPING_REFRESH_S = 20
+
+
+class TypingManager:
+    """
+    Manages the typing state of each room. Every generation marks the room as typing while it is running and the
+    typing state is only cleared when the last generation in the room finishes, so overlapping requests don't
+    clear each other's typing indicator. One heartbeat per room keeps the indicator alive.
+    """
+
+    def __init__(self, client: AsyncClient):
+        self._client = client
+        self._counts: Dict[str, int] = {}
+        self._heartbeats: Dict[str, asyncio.Task] = {}
+        # Rooms the homeserver was told we are typing in.
+        self._typing: Set[str] = set()
+        # A room's lock only exists while typing requests for it are in flight.
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}
+
+    async def start(self, room_id: str):
+        self._counts[room_id] = self._counts.get(room_id, 0) + 1
+        if room_id not in self._heartbeats:
+            self._heartbeats[room_id] = asyncio.create_task(self._heartbeat(room_id))
+
+    async def stop(self, room_id: str):
+        count = self._counts.get(room_id, 0) - 1
+        if count > 0:
+            self._counts[room_id] = count
+            return
+        self._counts.pop(room_id, None)
+        heartbeat = self._heartbeats.pop(room_id, None)
+        if heartbeat:
+            heartbeat.cancel()
+        await self._set_typing(room_id, False)
+
+    async def _heartbeat(self, room_id: str):
+        while True:
+            await self._set_typing(room_id, True)
+            await asyncio.sleep(TYPING_REFRESH_S)
+
+    async def _set_typing(self, room_id: str, typing_state: bool):
+        lock = self._locks.setdefault(room_id, asyncio.Lock())
+        self._lock_users[room_id] = self._lock_users.get(room_id, 0) + 1
+        try:
+            async with lock:
+                if typing_state != (room_id in self._counts):
+                    # The room's state changed while we were waiting on the lock.
+                    return
+                if not typing_state and room_id not in self._typing:
+                    # The generation finished before the heartbeat turned typing on.
+                    return
+                if typing_state:
+                    self._typing.add(room_id)
+                try:
+                    await self._client.room_typing(room_id, typing_state=typing_state, timeout=TYPING_TIMEOUT_MS)
+                except Exception as e:
+                    logger.warning(f'Failed to set typing state in {room_id}: {e}')
+                if not typing_state:
+                    self._typing.discard(room_id)
+        finally:
+            users = self._lock_users[room_id] - 1
+            if users:
+                self._lock_users[room_id] = users
+            else:
+                del self._lock_users[room_id]
+                del self._locks[room_id]
+
+
+class ReadMarkerManager:
     """
-    A background thread that manages typing states and resets them per-room when all threads are finished.
+    Moves the read marker of each room to the newest event, at most once every `debounce` seconds.
+    All the events marked as read during that time are combined into one request for the latest one.
     """
-    # TODO: create a class that maps room ID + event ID and threads mark themselves as typing and removes their mapping when they finish.
-    # TODO: this thread clears the typing state per room when all threads say they're finished.
-    return
+
+    def __init__(self, send: Callable[[str, str], Awaitable], debounce: float):
+        self._send = send
+        self.debounce = debounce
+        self._latest: Dict[str, str] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._marked = 0
+        self._sent = 0
+
+    def mark(self, room_id: str, event_id: str):
+        self._latest[room_id] = event_id
+        self._marked += 1
+        if room_id not in self._pending:
+            self._pending[room_id] = asyncio.create_task(self._flush_later(room_id))
+
+    async def _flush_later(self, room_id: str):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            del self._pending[room_id]
+        event_id = self._latest.pop(room_id)
+        self._sent += 1
+        try:
+            await self._send(room_id, event_id)
+        except Exception as e:
+            read_marker_logger.warning(f'Failed to set the read marker in {room_id}: {e}')
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'marked': self._marked,
+            'sent': self._sent,
+        }
@@ -7,8 +7,12 @@ from nio import (AsyncClient, InviteMemberEvent, MatrixRoom, MegolmEvent, RoomMe
 
 from .chat_functions import check_authorized, is_thread, check_command_prefix
 from .config import global_config
+from .dedup import SeenEvents
 from .handle_actions import do_reply_msg, do_reply_threaded_msg, do_join_channel, sound_off
 from .matrix_helper import MatrixClientHelper
+from .metrics import metrics
+from .scheduler import request_scheduler
+from .thread_cache import thread_cache, thread_command_cache
 
 
 class MatrixBotCallbacks:
@@ -17,27 +21,66 @@ class MatrixBotCallbacks:
         self.client: AsyncClient = client.client
         self.logger = logging.getLogger('MatrixGPT').getChild('MatrixBotCallbacks')
         self.startup_ts = time.time() * 1000
-        self.seen_messages = set()
+        self.seen_messages = SeenEvents()
+        metrics.register('seen_messages', self.seen_messages.stats)
+        self._catchup_until = None
+        self._catchup_semaphore = None
+        self._catchup_tasks = []
+
+    def start_catchup(self, since_ts: int):
+        """
+        Also handle the messages sent since `since_ts` (the last sync checkpoint) while the bot was offline.
+        They are handled `sync.catchup_concurrency` at a time so that a long backlog doesn't hold up new messages.
+        """
+        self._catchup_until = self.startup_ts
+        self.startup_ts = max(since_ts, self.startup_ts - global_config['sync']['catchup_max_age'] * 1000)
+        self._catchup_semaphore = asyncio.Semaphore(global_config['sync']['catchup_concurrency'])
+
+    async def finish_catchup(self, start: float):
+        """
+        Wait for the messages from the catch-up to be handled.
+        """
+        tasks = self._catchup_tasks
+        self._catchup_tasks = []
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._catchup_semaphore = None
+        self.logger.info(f'Caught up on {len(tasks)} missed messages in {round(time.monotonic() - start, 2)}s')
+
+    def _spawn(self, coro, event):
+        if self._catchup_semaphore is not None and event.server_timestamp < self._catchup_until:
+            self._catchup_tasks.append(request_scheduler.spawn(self._run_catchup(coro)))
+        else:
+            request_scheduler.spawn(coro)
+
+    async def _run_catchup(self, coro):
+        async with self._catchup_semaphore:
+            await coro
 
     async def handle_message(self, room: MatrixRoom, requestor_event: Union[RoomMessageText, RoomMessageImage]) -> None:
         """
         Callback for when a message event is received.
         """
-        mark_read_task = asyncio.create_task(self.client.room_read_markers(room.room_id, requestor_event.event_id, requestor_event.event_id))  # Mark all messages as read.
+        self.client_helper.mark_read(room.room_id, requestor_event.event_id)  # Mark all messages as read.
         msg = requestor_event.body.strip().strip('\n')
         if msg == "** Unable to decrypt: The sender's device has not sent us the keys for this message. **":
             self.logger.debug(f'Unable to decrypt event "{requestor_event.event_id} in room {room.room_id}')
             return
+        if requestor_event.source['content'].get('m.relates_to', {}).get('rel_type') == 'm.replace':
+            # Keep cached threads up to date with edits, like the ones made when streaming a response.
+            thread_cache.apply_edit(room.room_id, requestor_event)
+        elif is_thread(requestor_event):
+            # Record every threaded message, including our own replies, so that replies in the thread don't need to fetch it later.
+            thread_cache.add_event(room.room_id, requestor_event)
         if requestor_event.server_timestamp < self.startup_ts:
             return
         if requestor_event.sender == self.client.user_id:
             return
         if msg == '!bots' or msg == '!matrixgpt':
             self.logger.debug(f'Message from {requestor_event.sender} in {room.room_id} --> "{msg}"')
-            await sound_off(room, requestor_event, self.client_helper)
+            self._spawn(sound_off(room, requestor_event, self.client_helper), requestor_event)
             return
         if requestor_event.event_id in self.seen_messages:
-            # Need to track messages manually because the sync background thread may trigger the callback.
+            # Need to track messages manually because a sync after reconnecting may trigger the callback again.
             return
         self.seen_messages.add(requestor_event.event_id)
         command_activated, command_info = check_command_prefix(msg)
@@ -46,15 +89,18 @@ class MatrixBotCallbacks:
             # Threaded messages
             self.logger.debug(f'Message from {requestor_event.sender} in {room.room_id} --> "{msg}"')
             # Start the task in the background and don't wait for it here or else we'll block everything.
-            task = asyncio.create_task(do_reply_threaded_msg(self.client_helper, room, requestor_event))
+            self._spawn(do_reply_threaded_msg(self.client_helper, room, requestor_event), requestor_event)
         elif isinstance(requestor_event, RoomMessageText) and command_activated and not is_thread(requestor_event):
             # Everything else. Images do not start threads.
             self.logger.debug(f'Message from {requestor_event.sender} in {room.room_id} --> "{msg}"')
-            allowed_to_chat = command_info.allowed_to_chat + global_config['allowed_to_chat']
-            if not check_authorized(requestor_event.sender, allowed_to_chat):
-                await self.client_helper.react_to_event(room.room_id, requestor_event.event_id, '🚫', extra_error='Not allowed to chat.' if global_config['send_extra_messages'] else None)
+            # This message will be the root of the bot's thread.
+            thread_cache.add_event(room.room_id, requestor_event)
+            thread_command_cache.put(room.room_id, requestor_event.event_id, command_info)
+            if not check_authorized(requestor_event.sender, command_info.command_acl):
+                # Sends go through the room's send queue, which can wait out rate limits. Don't hold up the sync loop for that.
+                self._spawn(self.client_helper.react_to_event(room.room_id, requestor_event.event_id, '🚫', extra_error='Not allowed to chat.' if global_config['send_extra_messages'] else None), requestor_event)
                 return
-            task = asyncio.create_task(do_reply_msg(self.client_helper, room, requestor_event, command_info))
+            self._spawn(do_reply_msg(self.client_helper, room, requestor_event, command_info), requestor_event)
 
     async def handle_invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Callback for when an invite is received. Join the room specified in the invite.
@@ -69,16 +115,16 @@ class MatrixBotCallbacks:
         This makes sure we only call `callbacks.invite` with our own invite events.
         """
         if event.state_key == self.client.user_id:
-            task = asyncio.create_task(do_join_channel(self.client_helper, room, event))
+            request_scheduler.spawn(do_join_channel(self.client_helper, room, event))
 
     async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent) -> None:
         """
         Callback for when an event fails to decrypt. Inform the user.
         """
-        await self.client.room_read_markers(room.room_id, event.event_id, event.event_id)
+        self.client_helper.mark_read(room.room_id, event.event_id)
         if event.server_timestamp > self.startup_ts:
             self.logger.critical(f'Decryption failure for event {event.event_id} in room {room.room_id}')
-            await self.client_helper.react_to_event(room.room_id, event.event_id, "❌ 🔐")
+            self._spawn(self.client_helper.react_to_event(room.room_id, event.event_id, "❌ 🔐"), event)
 
     async def unknown(self, room: MatrixRoom, event: UnknownEvent) -> None:
         """
@@ -86,4 +132,4 @@ class MatrixBotCallbacks:
         Currently this is used for reaction events, which are not yet part of a released
         matrix spec (and are thus unknown to nio).
         """
-        await self.client.room_read_markers(room.room_id, event.event_id, event.event_id)
+        self.client_helper.mark_read(room.room_id, event.event_id)
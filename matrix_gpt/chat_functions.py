@@ -1,11 +1,13 @@
 import logging
 from typing import List, Tuple
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote, urlencode
 
-from nio import AsyncClient, Event, MatrixRoom, RoomGetEventResponse, RoomMessageText
+from nio import AsyncClient, Event, MatrixRoom, MegolmEvent, RoomGetEventResponse, RoomMessageText
 
+from matrix_gpt.acl import Acl, compile_acl, is_allowed
 from matrix_gpt.config import global_config
 from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.thread_cache import thread_cache, thread_command_cache, apply_bundled_edit
 
 logger = logging.getLogger('MatrixGPT').getChild('ChatFunctions')
 
@@ -15,76 +17,173 @@ def is_thread(event: RoomMessageText):
 
 
 def check_command_prefix(string: str) -> Tuple[bool, CommandInfo | None]:
-    for k, v in global_config.command_prefixes.items():
-        if string.startswith(f'{k} '):
-            command_info = CommandInfo(**v)
-            return True, command_info
-    return False,  None
+    command_info = global_config.match_command(string)
+    return command_info is not None, command_info
 
 
 async def is_this_our_thread(client: AsyncClient, room: MatrixRoom, event: RoomMessageText) -> Tuple[bool, CommandInfo | None]:
     base_event_id = event.source['content'].get('m.relates_to', {}).get('event_id')
     if base_event_id:
-        e = await client.room_get_event(room.room_id, base_event_id)
-        if not isinstance(e, RoomGetEventResponse):
-            logger.critical(f'Failed to get event in is_this_our_thread(): {vars(e)}')
+        cached, command_info = thread_command_cache.get(room.room_id, base_event_id)
+        if cached:
+            return command_info is not None, command_info
+
+        root_event = thread_cache.get_event(room.room_id, base_event_id, base_event_id)
+        if not root_event:
+            e = await client.room_get_event(room.room_id, base_event_id)
+            if not isinstance(e, RoomGetEventResponse):
+                logger.critical(f'Failed to get event in is_this_our_thread(): {vars(e)}')
+                return False, None
+            root_event = e.event
+            apply_bundled_edit(root_event)
+            thread_cache.put_event(room.room_id, base_event_id, root_event)
+        if isinstance(root_event, MegolmEvent):
+            # Don't remember this since we may be able to decrypt it later.
             return False, None
-        else:
-            return check_command_prefix(e.event.body)
+
+        result = check_command_prefix(getattr(root_event, 'body', ''))
+        thread_command_cache.put(room.room_id, base_event_id, result[1])
+        return result
     else:
         return False, None
 
 
+async def get_thread_event(client: AsyncClient, room: MatrixRoom, thread_root_id: str, event_id: str, cache_only: bool = False) -> Event | None:
+    """
+    Get an event in a thread, only asking the homeserver if it isn't already in the thread cache.
+    If `cache_only` is set, return None instead of fetching a missing event.
+    """
+    event = thread_cache.get_event(room.room_id, thread_root_id, event_id)
+    if event or cache_only:
+        return event
+    resp = await client.room_get_event(room.room_id, event_id)
+    if not isinstance(resp, RoomGetEventResponse):
+        raise Exception(f'Failed to get event {event_id} in room {room.room_id}: {vars(resp)}')
+    apply_bundled_edit(resp.event)
+    thread_cache.put_event(room.room_id, thread_root_id, resp.event)
+    return resp.event
+
+
 async def get_thread_content(client: AsyncClient, room: MatrixRoom, base_event: RoomMessageText) -> List[Event]:
+    thread_root_id = base_event.source['content']['m.relates_to']['event_id']
+
+    # If the whole thread is already cached we don't need to talk to the homeserver at all.
+    messages = await _walk_thread_chain(client, room, thread_root_id, base_event, cache_only=True)
+    if messages is not None:
+        return messages
+
+    if global_config['thread_fetch']['mode'] == 'relations':
+        messages = await _get_thread_relations(client, room, thread_root_id, base_event)
+        if messages is not None:
+            return messages
+
+    return await _walk_thread_chain(client, room, thread_root_id, base_event)
+
+
+async def _walk_thread_chain(client: AsyncClient, room: MatrixRoom, thread_root_id: str, base_event: RoomMessageText, cache_only: bool = False) -> List[Event] | None:
+    """
+    Build the thread by following the `m.in_reply_to` chain back to the root, one event at a time.
+    """
     messages = []
 
     # This is the event of the message that was just sent.
-    new_event = (await client.room_get_event(room.room_id, base_event.event_id)).event
+    new_event = await get_thread_event(client, room, thread_root_id, base_event.event_id, cache_only)
 
-    while True:
+    while new_event:
         if new_event.source['content'].get('m.relates_to', {}).get('rel_type') == 'm.thread':
             # Put the event in the messages list only if it's related to the thread we're parsing.
             messages.append(new_event)
         else:
             break
         # Fetch the next event.
-        new_event = (await client.room_get_event(
-            room.room_id,
-            new_event.source['content']['m.relates_to']['m.in_reply_to']['event_id'])
-                     ).event
+        new_event = await get_thread_event(
+            client,
+            room,
+            thread_root_id,
+            new_event.source['content']['m.relates_to']['m.in_reply_to']['event_id'],
+            cache_only
+        )
+    if not new_event:
+        # Only happens when `cache_only` is set and we hit an event we haven't seen.
+        return None
 
     # Put the root event in the array.
-    messages.append((await client.room_get_event(
-        room.room_id, base_event.source['content']['m.relates_to']['event_id'])
-                     ).event)
+    root_event = await get_thread_event(client, room, thread_root_id, thread_root_id, cache_only)
+    if not root_event:
+        return None
+    messages.append(root_event)
     messages.reverse()
     return messages
 
 
+_relations_supported = True
+
+
+async def _get_thread_relations(client: AsyncClient, room: MatrixRoom, thread_root_id: str, base_event: RoomMessageText) -> List[Event] | None:
+    """
+    Fetch every `m.thread` relation of the root event in paginated batches using the relations API.
+    Returns None if the homeserver doesn't support the relations API.
+    """
+    global _relations_supported
+    if not _relations_supported:
+        return None
+
+    thread_events = {}
+    next_batch = None
+    while True:
+        query = {'dir': 'f', 'limit': global_config['thread_fetch']['batch_size']}
+        if next_batch:
+            query['from'] = next_batch
+        path = f'/_matrix/client/v1/rooms/{quote(room.room_id, safe="")}/relations/{quote(thread_root_id, safe="")}/m.thread?{urlencode(query)}'
+        resp = await client.send('GET', path, headers={'Authorization': f'Bearer {client.access_token}'})
+        try:
+            data = await resp.json()
+        except Exception:
+            data = {}
+        if resp.status in (400, 404, 405) and data.get('errcode', 'M_UNRECOGNIZED') == 'M_UNRECOGNIZED':
+            logger.warning(f'Homeserver does not support the relations API, falling back to walking the reply chain: {data}')
+            _relations_supported = False
+            return None
+        elif resp.status != 200:
+            raise Exception(f'Failed to get thread relations for {thread_root_id} in room {room.room_id}: {resp.status} {data}')
+
+        for item in data.get('chunk', []):
+            event = Event.parse_event(item)
+            if not isinstance(event, Event):
+                continue
+            cached = thread_cache.get_event(room.room_id, thread_root_id, event.event_id)
+            if cached:
+                # Prefer the cached copy, it came from the sync and was decrypted.
+                event = cached
+            elif isinstance(event, MegolmEvent):
+                # The relations API isn't decrypted by Pantalaimon so get this one the slow way.
+                event = await get_thread_event(client, room, thread_root_id, event.event_id)
+            else:
+                apply_bundled_edit(event)
+                thread_cache.put_event(room.room_id, thread_root_id, event)
+            thread_events[event.event_id] = event
+
+        next_batch = data.get('next_batch')
+        if not next_batch:
+            break
+
+    # Messages sent to the thread after the one we're replying to are not part of the context.
+    thread_events[base_event.event_id] = await get_thread_event(client, room, thread_root_id, base_event.event_id)
+    messages = sorted(
+        (e for e in thread_events.values() if e.server_timestamp <= base_event.server_timestamp),
+        key=lambda e: e.server_timestamp
+    )
+    messages.insert(0, await get_thread_event(client, room, thread_root_id, thread_root_id))
+    return messages
+
+
 def check_authorized(string, to_check):
-    def check_str(s, c):
-        if c == 'all':
-            return True
-        else:
-            if '@' not in c and ':' not in c:
-                # Homeserver
-                if s.split(':')[-1] in c:
-                    return True
-            elif s in c:
-                # By username
-                return True
-        return False
-
-    if isinstance(to_check, str):
-        return check_str(string, to_check)
-    elif isinstance(to_check, list):
-        output = False
-        for item in to_check:
-            if check_str(string, item):
-                output = True
-        return output
-    else:
+    """
+    Check if the user ID `string` is allowed by `to_check`, which can be a single entry, a list of entries, or a compiled `Acl`.
+    """
+    if not isinstance(to_check, (str, list, tuple, Acl)):
         raise Exception
+    return is_allowed(string, compile_acl(to_check))
 
 
 async def download_mxc(url: str, client: AsyncClient) -> bytes:
@@ -1,11 +1,19 @@
 import copy
+import re
 from pathlib import Path
 from types import NoneType
 
 import bison
 from bison.errors import SchemeValidationError
 
+from matrix_gpt.acl import clear_acl_cache
+
 VALID_API_TYPES = ['openai', 'anthropic', 'copilot']
+VALID_IMAGE_FORMATS = ['png', 'jpeg', 'webp']
+VALID_HISTORY_MODES = ['full', 'summary', 'retrieval']
+VALID_ROUTING = ['least_outstanding', 'weighted_round_robin']
+
+DEFAULT_SUMMARY_PROMPT = 'Summarize the conversation below so that it can be continued without the full transcript. Keep any facts, names, decisions, code, and open questions that may be needed later. Only reply with the summary.'
 
 config_scheme = bison.Scheme(
     bison.Option('store_path', default='bot-store/', field_type=str),
@@ -21,6 +29,7 @@ config_scheme = bison.Scheme(
     bison.ListOption('autojoin_rooms', default=[]),
     bison.ListOption('blacklist_rooms', default=[]),
     bison.Option('response_timeout', default=120, field_type=int),
+    bison.Option('stream_edit_interval', default=2, field_type=[int, float]),
     bison.ListOption('command', required=True, member_scheme=bison.Scheme(
         bison.Option('trigger', field_type=str, required=True),
         bison.Option('api_type', field_type=str, choices=VALID_API_TYPES, required=True),
@@ -35,20 +44,103 @@ config_scheme = bison.Scheme(
         bison.Option('api_base', field_type=[str, NoneType], default=None),
         bison.Option('vision', field_type=bool, default=False),
         bison.Option('help', field_type=[str, NoneType], default=None),
+        bison.Option('stream', field_type=bool, default=False),
+        bison.Option('context_window', field_type=int, default=0),
+        bison.Option('context_reserve', field_type=int, default=0),
+        bison.Option('history_mode', field_type=str, choices=VALID_HISTORY_MODES, default='full'),
+        bison.ListOption('endpoints', default=[]),
+        bison.Option('routing', field_type=str, choices=VALID_ROUTING, default='least_outstanding'),
     )),
     bison.DictOption('openai', scheme=bison.Scheme(
         bison.Option('api_key', field_type=[str, NoneType], default=None, required=False),
+        bison.Option('image_format', field_type=str, choices=VALID_IMAGE_FORMATS, default='jpeg'),
+        bison.Option('image_quality', field_type=int, default=85),
     )),
     bison.DictOption('anthropic', scheme=bison.Scheme(
         bison.Option('api_key', field_type=[str, NoneType], required=False, default=None),
+        bison.Option('image_format', field_type=str, choices=VALID_IMAGE_FORMATS, default='jpeg'),
+        bison.Option('image_quality', field_type=int, default=85),
     )),
     bison.DictOption('copilot', scheme=bison.Scheme(
         bison.Option('api_key', field_type=[str, NoneType], required=False, default=None),
         bison.Option('event_encryption_key', field_type=[str, NoneType], required=False, default=None),
     )),
+    bison.DictOption('scheduler', scheme=bison.Scheme(
+        bison.Option('max_in_flight', default=4, field_type=int),
+        bison.Option('max_queued', default=50, field_type=int),
+        bison.Option('queued_reaction', default='⏳', field_type=[str, NoneType]),
+    )),
+    bison.DictOption('api_clients', scheme=bison.Scheme(
+        bison.Option('max_connections', default=100, field_type=int),
+        bison.Option('max_keepalive_connections', default=20, field_type=int),
+        bison.Option('keepalive_expiry', default=60, field_type=[int, float]),
+    )),
+    bison.DictOption('thread_cache', scheme=bison.Scheme(
+        bison.Option('max_events', default=5000, field_type=int),
+        bison.Option('max_roots', default=10000, field_type=int),
+    )),
+    bison.DictOption('thread_fetch', scheme=bison.Scheme(
+        bison.Option('mode', default='relations', field_type=str, choices=['relations', 'chain']),
+        bison.Option('batch_size', default=50, field_type=int),
+    )),
+    bison.DictOption('endpoint_pool', scheme=bison.Scheme(
+        bison.Option('max_failures', default=3, field_type=int),
+        bison.Option('ejection_time', default=30, field_type=[int, float]),
+        bison.Option('max_ejection_time', default=300, field_type=[int, float]),
+    )),
+    bison.DictOption('rate_limit', scheme=bison.Scheme(
+        bison.Option('enabled', default=True, field_type=bool),
+        bison.Option('max_wait', default=30, field_type=[int, float]),
+    )),
+    bison.DictOption('sync', scheme=bison.Scheme(
+        bison.Option('checkpoint_interval', default=30, field_type=int),
+        bison.Option('lazy_load_members', default=True, field_type=bool),
+        bison.Option('timeline_limit', default=None, field_type=[int, NoneType]),
+        bison.Option('full_state', default=False, field_type=bool),
+        bison.Option('startup_mode', default='skip', field_type=str, choices=['skip', 'catchup']),
+        bison.Option('catchup_timeline_limit', default=50, field_type=int),
+        bison.Option('catchup_max_age', default=3600, field_type=int),
+        bison.Option('catchup_concurrency', default=2, field_type=int),
+    )),
+    bison.DictOption('send_queue', scheme=bison.Scheme(
+        bison.Option('max_retries', default=5, field_type=int),
+    )),
+    bison.DictOption('read_markers', scheme=bison.Scheme(
+        bison.Option('debounce', default=2, field_type=[int, float]),
+    )),
+    bison.DictOption('dedup', scheme=bison.Scheme(
+        bison.Option('capacity', default=50000, field_type=int),
+        bison.Option('error_rate', default=0.0001, field_type=float),
+    )),
+    bison.DictOption('summary', scheme=bison.Scheme(
+        bison.Option('threshold', default=40, field_type=int),
+        bison.Option('keep_recent', default=10, field_type=int),
+        bison.Option('max_tokens', default=1024, field_type=int),
+        bison.Option('prompt', default=DEFAULT_SUMMARY_PROMPT, field_type=str),
+    )),
+    bison.DictOption('retrieval', scheme=bison.Scheme(
+        bison.Option('backend', default='hashing', field_type=str, choices=['hashing', 'openai']),
+        bison.Option('model', default='text-embedding-3-small', field_type=str),
+        bison.Option('api_base', default=None, field_type=[str, NoneType]),
+        bison.Option('dimensions', default=512, field_type=int),
+        bison.Option('top_k', default=6, field_type=int),
+        bison.Option('keep_recent', default=10, field_type=int),
+        bison.Option('max_threads', default=100, field_type=int),
+        bison.Option('persist', default=True, field_type=bool),
+    )),
+    bison.DictOption('image', scheme=bison.Scheme(
+        bison.Option('process_workers', default=2, field_type=int),
+        bison.Option('download_concurrency', default=4, field_type=int),
+    )),
+    bison.DictOption('image_cache', scheme=bison.Scheme(
+        bison.Option('memory_bytes', default=64 * 1024 * 1024, field_type=int),
+        bison.Option('disk', default=False, field_type=bool),
+        bison.Option('disk_bytes', default=512 * 1024 * 1024, field_type=int),
+    )),
     bison.DictOption('logging', scheme=bison.Scheme(
         bison.Option('log_level', field_type=str, default='info'),
         bison.Option('log_full_response', field_type=bool, default=True),
+        bison.Option('metrics_interval', field_type=int, default=0),
     )),
 )
 # Bison does not support list default options in certain situations.
@@ -65,6 +157,12 @@ DEFAULT_LISTS = {
         'api_base': None,
         'vision': False,
         'help': None,
+        'stream': False,
+        'context_window': 0,
+        'context_reserve': 0,
+        'history_mode': 'full',
+        'endpoints': [],
+        'routing': 'least_outstanding',
     }
 }
 
@@ -73,6 +171,8 @@ class ConfigManager:
     def __init__(self):
         self._config = bison.Bison(scheme=config_scheme)
         self._command_prefixes = {}
+        self._command_infos = {}
+        self._command_matcher = None
         self._parsed_config = {}
         self._loaded = False
         self._validated = False
@@ -92,13 +192,47 @@ class ConfigManager:
         for api in VALID_API_TYPES:
             if self._config.config[api].get('api_key'):
                 config_api_keys += 1
-        if config_api_keys < 1:
+        if config_api_keys < 1 and not any(item.get('endpoints') for item in self._config.config['command']):
+            # Commands with endpoints don't need the global key.
             raise SchemeValidationError('You need an API key')
         self._parsed_config = self._merge_in_list_defaults()
 
         for item in self._config.config['command']:
             if item['api_type'] == 'copilot' and item['model'] != 'copilot':
                 raise SchemeValidationError('The Copilot model type must be set to `copilot`')
+            if item['api_type'] == 'copilot' and item.get('stream'):
+                raise SchemeValidationError('Copilot does not support streaming')
+            if item['api_type'] == 'copilot' and item.get('history_mode', 'full') != 'full':
+                raise SchemeValidationError('Copilot keeps its own conversation history and must use the `full` history mode')
+            if item.get('endpoints'):
+                if item['api_type'] != 'openai':
+                    raise SchemeValidationError(f'`endpoints` for {item["trigger"]} is only supported by the `openai` API type')
+                if item.get('api_base'):
+                    raise SchemeValidationError(f'{item["trigger"]} can only have one of `api_base` and `endpoints`')
+                for endpoint in item['endpoints']:
+                    if not isinstance(endpoint, dict) or not isinstance(endpoint.get('url'), str):
+                        raise SchemeValidationError(f'Every endpoint for {item["trigger"]} needs a `url`')
+                    if not isinstance(endpoint.get('weight', 1), (int, float)) or endpoint.get('weight', 1) <= 0:
+                        raise SchemeValidationError(f'The weight of endpoint {endpoint["url"]} must be a positive number')
+            if item.get('context_window', 0) > 0 and max(item.get('context_reserve', 0), item.get('max_tokens', 0)) >= item['context_window']:
+                raise SchemeValidationError(f'`context_window` for {item["trigger"]} must be larger than `context_reserve` and `max_tokens`')
+
+        for api in ('openai', 'anthropic'):
+            if not 1 <= self._config.config[api]['image_quality'] <= 100:
+                raise SchemeValidationError(f'`{api}.image_quality` must be between 1 and 100')
+
+        if self._config.config['rate_limit']['max_wait'] >= self._config.config['response_timeout']:
+            # Requests are held inside the response timeout.
+            raise SchemeValidationError('`rate_limit.max_wait` must be smaller than `response_timeout`')
+
+        if self._config.config['dedup']['capacity'] < 1 or not 0 < self._config.config['dedup']['error_rate'] < 1:
+            raise SchemeValidationError('`dedup.capacity` must be at least 1 and `dedup.error_rate` must be between 0 and 1')
+
+        if self._config.config['summary']['keep_recent'] >= self._config.config['summary']['threshold']:
+            raise SchemeValidationError('`summary.keep_recent` must be smaller than `summary.threshold`')
+
+        if self._config.config['retrieval']['backend'] == 'openai' and not self._config.config['openai'].get('api_key'):
+            raise SchemeValidationError('The `openai` retrieval backend needs an OpenAI API key')
 
         # Make sure there aren't duplicate triggers
         existing_triggers = []
@@ -112,6 +246,8 @@ class ConfigManager:
             raise SchemeValidationError('You must set `event_encryption_key` when using copilot')
 
         self._command_prefixes = self._generate_command_prefixes()
+        clear_acl_cache()
+        self._command_infos, self._command_matcher = self._compile_commands()
 
     def _merge_in_list_defaults(self):
         new_config = copy.copy(self._config.config)
@@ -141,10 +277,31 @@ class ConfigManager:
 
         return command_prefixes
 
+    def _compile_commands(self):
+        """
+        Create the shared `CommandInfo` for each command and a regex that matches any trigger followed by a space.
+        The alternatives are in config order so the first matching command wins, the same as checking them one by one.
+        """
+        # Imported here because CommandInfo needs the global config.
+        from matrix_gpt.generate_clients.command_info import CommandInfo
+        command_infos = {trigger: CommandInfo(**item) for trigger, item in self._command_prefixes.items()}
+        if not command_infos:
+            return command_infos, None
+        return command_infos, re.compile('(' + '|'.join(re.escape(trigger) for trigger in command_infos) + ') ')
+
     @property
     def command_prefixes(self):
         return self._command_prefixes
 
+    def match_command(self, string: str):
+        """
+        Get the `CommandInfo` of the command that `string` starts with, or None.
+        """
+        if self._command_matcher is None:
+            return None
+        m = self._command_matcher.match(string)
+        return self._command_infos[m.group(1)] if m else None
+
     def get(self, key, default=None):
         return copy.copy(self._config.get(key, default))
 
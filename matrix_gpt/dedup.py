@@ -0,0 +1,70 @@
+import hashlib
+import math
+
+from matrix_gpt.config import global_config
+
+
+class _BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    @property
+    def error_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class SeenEvents:
+    """
+    Remembers which event IDs were already handled using a fixed amount of memory. Two Bloom filters are kept and once
+    the newest one holds `dedup.capacity` events the oldest is thrown away, so the last `dedup.capacity` to
+    `2 * dedup.capacity` events are always remembered. A Bloom filter can say an event was seen when it wasn't,
+    at most `dedup.error_rate` of the time per filter.
+    """
+
+    def __init__(self):
+        self._current = None
+        self._previous = None
+
+    def _filter(self) -> _BloomFilter:
+        if self._current is None:
+            self._current = _BloomFilter(global_config['dedup']['capacity'], global_config['dedup']['error_rate'])
+        return self._current
+
+    def add(self, event_id: str):
+        current = self._filter()
+        if current.count >= global_config['dedup']['capacity']:
+            self._previous = current
+            self._current = None
+            current = self._filter()
+        current.add(event_id)
+
+    def __contains__(self, event_id: str):
+        return event_id in self._filter() or (self._previous is not None and event_id in self._previous)
+
+    def __len__(self):
+        return self._filter().count + (self._previous.count if self._previous else 0)
+
+    def stats(self) -> dict:
+        filters = [f for f in (self._current, self._previous) if f is not None]
+        return {
+            'events': len(self),
+            'bytes': sum(len(f._bits) for f in filters),
+            'error_rate': 1 - math.prod(1 - f.error_rate for f in filters),
+        }
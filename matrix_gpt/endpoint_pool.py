@@ -0,0 +1,155 @@
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import openai
+
+from matrix_gpt.config import global_config
+from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.metrics import metrics
+
+logger = logging.getLogger('MatrixGPT').getChild('EndpointPool')
+
+# Errors that mean the endpoint is down rather than that something was wrong with the request.
+ENDPOINT_ERRORS = (openai.APIConnectionError, openai.InternalServerError, httpx.TransportError)
+
+# The key for endpoints that don't have an `api_key`. The SDK needs some key, and the OpenAI key shouldn't be sent to
+# self-hosted servers.
+NO_API_KEY = 'no-api-key'
+
+
+class Endpoint:
+    def __init__(self, url: str, weight: float = 1, api_key: str = None):
+        self.url = url
+        self.weight = weight
+        self.api_key = api_key
+        self.outstanding = 0
+        self.current_weight = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class EndpointPool:
+    """
+    Spreads a command's requests over several endpoints. Endpoints are picked by the fewest requests in progress
+    (relative to their weight) or by weighted round-robin. An endpoint that fails `endpoint_pool.max_failures` times
+    in a row is ejected for `endpoint_pool.ejection_time` seconds, doubling each time it is ejected again, and is tried
+    again once that time has passed.
+    """
+
+    def __init__(self, endpoints: List[Endpoint], routing: str):
+        self.endpoints = endpoints
+        self.routing = routing
+
+    def pick(self, exclude=()) -> Optional[Endpoint]:
+        now = time.monotonic()
+        remaining = [e for e in self.endpoints if e not in exclude]
+        candidates = [e for e in remaining if e.available(now)]
+        if not candidates:
+            # Everything is ejected, try the endpoint that will be re-admitted first instead of failing the request.
+            candidates = sorted(remaining, key=lambda e: e.ejected_until)[:1]
+            if not candidates:
+                return None
+        if self.routing == 'least_outstanding':
+            return min(candidates, key=lambda e: (e.outstanding / e.weight, -e.weight))
+        # Smooth weighted round-robin.
+        total = 0
+        for e in candidates:
+            e.current_weight += e.weight
+            total += e.weight
+        best = max(candidates, key=lambda e: e.current_weight)
+        best.current_weight -= total
+        return best
+
+    def record_success(self, endpoint: Endpoint):
+        endpoint.failures = 0
+        endpoint.ejections = 0
+
+    def record_failure(self, endpoint: Endpoint):
+        config = global_config['endpoint_pool']
+        endpoint.errors += 1
+        endpoint.failures += 1
+        if endpoint.failures >= config['max_failures']:
+            endpoint.ejections += 1
+            ejection_time = min(config['max_ejection_time'], config['ejection_time'] * 2 ** (endpoint.ejections - 1))
+            endpoint.ejected_until = time.monotonic() + ejection_time
+            # One more failure after it is re-admitted ejects it again.
+            endpoint.failures = config['max_failures'] - 1
+            logger.warning(f'Ejected endpoint {endpoint.url} for {ejection_time}s')
+
+    async def call(self, command_info: CommandInfo, func: Callable[[CommandInfo], Awaitable], failover: bool = True):
+        """
+        Call `func` with a copy of `command_info` that points at an endpoint from the pool. If the endpoint can't be
+        reached the request is retried on the next endpoint, unless `failover` is False.
+        """
+        tried = []
+        while True:
+            endpoint = self.pick(tried)
+            tried.append(endpoint)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                result = await func(command_info.replace(api_base=endpoint.url, api_key=endpoint.api_key or NO_API_KEY))
+            except ENDPOINT_ERRORS as e:
+                self.record_failure(endpoint)
+                if not failover or len(tried) >= len(self.endpoints):
+                    raise
+                logger.warning(f'Endpoint {endpoint.url} failed for {command_info.trigger}, trying another: {e}')
+                continue
+            finally:
+                endpoint.outstanding -= 1
+            self.record_success(endpoint)
+            return result
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            e.url: {
+                'outstanding': e.outstanding,
+                'requests': e.requests,
+                'errors': e.errors,
+                'ejected': not e.available(now),
+            }
+            for e in self.endpoints
+        }
+
+
+class EndpointPools:
+    """
+    The endpoint pool of each command, created the first time the command is used.
+    """
+
+    def __init__(self):
+        self._pools: Dict[str, EndpointPool] = {}
+
+    def get(self, command_info: CommandInfo) -> Optional[EndpointPool]:
+        if not command_info.endpoints:
+            return None
+        pool = self._pools.get(command_info.trigger)
+        if pool is None:
+            endpoints = [Endpoint(e['url'], e.get('weight', 1), e.get('api_key')) for e in command_info.endpoints]
+            pool = self._pools[command_info.trigger] = EndpointPool(endpoints, command_info.routing)
+        return pool
+
+    async def call(self, command_info: CommandInfo, func: Callable[[CommandInfo], Awaitable], failover: bool = True):
+        """
+        Call `func` through the command's endpoint pool, or directly if the command doesn't have one.
+        """
+        pool = self.get(command_info)
+        if pool is None:
+            return await func(command_info)
+        return await pool.call(command_info, func, failover)
+
+    def stats(self) -> dict:
+        return {trigger: pool.stats() for trigger, pool in self._pools.items()}
+
+
+endpoint_pools = EndpointPools()
+metrics.register('endpoint_pools', endpoint_pools.stats)
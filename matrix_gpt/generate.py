@@ -1,23 +1,24 @@
 import asyncio
 import json
 import logging
+import time
 import traceback
-from typing import Union
+from typing import Union, Tuple
 
-from nio import RoomSendResponse, MatrixRoom, RoomMessageText
+from nio import RoomSendResponse, MatrixRoom, RoomMessageText, ErrorResponse
 
 from matrix_gpt import MatrixClientHelper
 from matrix_gpt.api_client_manager import api_client_helper
 from matrix_gpt.config import global_config
+from matrix_gpt.endpoint_pool import endpoint_pools
+from matrix_gpt.generate_clients.api_client import ApiClient
 from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.scheduler import request_scheduler, QueueFullError
+from matrix_gpt.summary import thread_summaries
 
 logger = logging.getLogger('MatrixGPT').getChild('Generate')
 
 
-# TODO: process_chat() will set typing as false after generating.
-# TODO: If there is still another query in-progress that typing state will be overwritten by the one that just finished.
-
-
 async def generate_ai_response(
         client_helper: MatrixClientHelper,
         room: MatrixRoom,
@@ -28,11 +29,10 @@ async def generate_ai_response(
         matrix_gpt_data: str = None
 ):
     assert isinstance(command_info, CommandInfo)
-    client = client_helper.client
     try:
-        await client.room_typing(room.room_id, typing_state=True, timeout=global_config['response_timeout'] * 1000)
+        await client_helper.typing.start(room.room_id)
 
-        api_client = api_client_helper.get_client(command_info.api_type, client_helper, room, event)
+        api_client = api_client_helper.get_client(command_info.api_type, client_helper, room, event, command_info)
         if not api_client:
             # If this was None then we were missing an API key for this client type. Error has already been logged.
             await client_helper.react_to_event(
@@ -41,7 +41,6 @@ async def generate_ai_response(
                 '❌',
                 extra_error=f'No API key for model {command_info.model}' if global_config['send_extra_messages'] else None
             )
-            await client.room_typing(room.room_id, typing_state=False, timeout=1000)
             return
 
         # The input context can be either a string if this is the first message in the thread or a list of all messages in the thread.
@@ -52,30 +51,67 @@ async def generate_ai_response(
         # Build the context and do the things that need to be done for our specific API type.
         api_client.assemble_context(context, system_prompt=command_info.system_prompt, injected_system_prompt=command_info.injected_system_prompt)
 
+        if command_info.context_window > 0:
+            # Leave room for the response.
+            reserve = command_info.context_reserve if command_info.context_reserve > 0 else command_info.max_tokens
+            removed = api_client.trim_context(command_info.context_window - reserve)
+            if removed:
+                logger.debug(f'Trimmed {removed} messages from the context for event {event.event_id} to fit the context window of {command_info.model}.')
+
+        # Only download the images that are left after trimming.
+        await api_client.fetch_images(global_config['image']['download_concurrency'])
+
         if api_client.check_ignore_request():
             logger.debug(f'Reply to {event.event_id} was ignored by the model "{command_info.model}".')
-            await client.room_typing(room.room_id, typing_state=False, timeout=1000)
             return
 
+        # Attach the thread's newest summary to our reply so that it is saved in the room.
+        summary_data = thread_summaries.get_unsaved(room.room_id, thread_root_id) if thread_root_id else {}
+
         response = None
         extra_data = None
+        streamed_resp = None
         try:
-            task = asyncio.create_task(api_client.generate(command_info, matrix_gpt_data))
-            for task in asyncio.as_completed([task], timeout=global_config['response_timeout']):
-                # TODO: add a while loop and heartbeat the background thread
-                try:
-                    response, extra_data = await task
-                    break
-                except asyncio.TimeoutError:
-                    logger.warning(f'Response to event {event.event_id} timed out.')
-                    await client_helper.react_to_event(
-                        room.room_id,
-                        event.event_id,
-                        '🕒',
-                        extra_error='Request timed out.' if global_config['send_extra_messages'] else None
-                    )
-                    await client.room_typing(room.room_id, typing_state=False, timeout=1000)
-                    return
+            async with request_scheduler.slot(client_helper, room, event, command_info):
+                if command_info.stream:
+                    # Part of the response may already be in the room when an endpoint fails so don't fail over.
+                    generate_task = asyncio.create_task(endpoint_pools.call(
+                        command_info,
+                        lambda ci: stream_ai_response(client_helper, room, event, api_client, ci, thread_root_id, matrix_gpt_data, summary_data),
+                        failover=False
+                    ))
+                else:
+                    generate_task = asyncio.create_task(endpoint_pools.call(command_info, lambda ci: api_client.generate(ci, matrix_gpt_data)))
+                for task in asyncio.as_completed([generate_task], timeout=global_config['response_timeout']):
+                    # TODO: add a while loop and heartbeat the background thread
+                    try:
+                        if command_info.stream:
+                            response, streamed_resp = await task
+                        else:
+                            response, extra_data = await task
+                        break
+                    except asyncio.TimeoutError:
+                        generate_task.cancel()
+                        logger.warning(f'Response to event {event.event_id} timed out.')
+                        if command_info.stream:
+                            # Let the streamed message be finalized before reacting.
+                            await asyncio.wait([generate_task])
+                        await client_helper.react_to_event(
+                            room.room_id,
+                            event.event_id,
+                            '🕒',
+                            extra_error='Request timed out.' if global_config['send_extra_messages'] else None
+                        )
+                        return
+        except QueueFullError as e:
+            logger.warning(f'Rejected event {event.event_id} in room {room.room_id}: {e}')
+            await client_helper.react_to_event(
+                room.room_id,
+                event.event_id,
+                '❌',
+                extra_error='Too many requests are queued.' if global_config['send_extra_messages'] else None
+            )
+            return
         except Exception:
             logger.error(f'Exception when generating for event {event.event_id}: {traceback.format_exc()}')
             await client_helper.react_to_event(
@@ -84,10 +120,9 @@ async def generate_ai_response(
                 '❌',
                 extra_error='Exception' if global_config['send_extra_messages'] else None
             )
-            await client.room_typing(room.room_id, typing_state=False, timeout=1000)
             return
 
-        if not response:
+        if not response or (command_info.stream and streamed_resp is None):
             logger.warning(f'Response to event {event.event_id} in room {room.room_id} was null.')
             await client_helper.react_to_event(
                 room.room_id,
@@ -95,7 +130,6 @@ async def generate_ai_response(
                 '❌',
                 extra_error='Response was null.' if global_config['send_extra_messages'] else None
             )
-            await client.room_typing(room.room_id, typing_state=False, timeout=1000)
             return
 
         # The AI's response.
@@ -103,6 +137,7 @@ async def generate_ai_response(
 
         if not extra_data:
             extra_data = {}
+        extra_data.update(summary_data)
 
         # Logging
         if global_config['logging']['log_full_response']:
@@ -122,20 +157,81 @@ async def generate_ai_response(
         z = text_response.replace("\n", "\\n")
         logger.info(f'Reply to {event.event_id} --> {command_info.model} responded with "{z}"')
 
-        # Send message to room
-        resp = await client_helper.send_text_to_room(
-            room.room_id,
-            text_response,
-            reply_to_event_id=event.event_id,
-            thread=True,
-            thread_root_id=thread_root_id if thread_root_id else event.event_id,
-            markdown_convert=True,
-            extra_data=extra_data
-        )
-        await client.room_typing(room.room_id, typing_state=False, timeout=1000)
+        if command_info.stream:
+            # The response was already sent to the room while it was generated.
+            resp = streamed_resp
+        else:
+            # Send message to room
+            resp = await client_helper.send_text_to_room(
+                room.room_id,
+                text_response,
+                reply_to_event_id=event.event_id,
+                thread=True,
+                thread_root_id=thread_root_id if thread_root_id else event.event_id,
+                markdown_convert=True,
+                extra_data=extra_data
+            )
         if not isinstance(resp, RoomSendResponse):
             logger.critical(f'Failed to respond to event {event.event_id} in room {room.room_id}:\n{vars(resp)}')
             await client_helper.react_to_event(room.room_id, event.event_id, '❌', extra_error='Exception' if global_config['send_extra_messages'] else None)
     except Exception:
         await client_helper.react_to_event(room.room_id, event.event_id, '❌', extra_error='Exception' if global_config['send_extra_messages'] else None)
         raise
+    finally:
+        await client_helper.typing.stop(room.room_id)
+
+
+async def stream_ai_response(
+        client_helper: MatrixClientHelper,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        api_client: ApiClient,
+        command_info: CommandInfo,
+        thread_root_id: str = None,
+        matrix_gpt_data: str = None,
+        extra_data: dict = None
+) -> Tuple[str | None, RoomSendResponse | ErrorResponse | None]:
+    """
+    Stream the response from the model into the room. The first tokens are sent as a new message which is then
+    edited as more of the response comes in, no more often than `stream_edit_interval`.
+    The last edit contains the complete response rendered as markdown. If the request is cancelled because it timed
+    out, the message is finalized with what was generated so far.
+    Returns the response and the result of sending the first message.
+    """
+    response = ''
+    first_resp = None
+    last_edit = 0
+    try:
+        async for text in api_client.generate_stream(command_info, matrix_gpt_data):
+            response += text
+            partial_response = response.strip().strip('\n')
+            if not partial_response:
+                continue
+            if not first_resp:
+                first_resp = await client_helper.send_text_to_room(
+                    room.room_id,
+                    partial_response,
+                    reply_to_event_id=event.event_id,
+                    thread=True,
+                    thread_root_id=thread_root_id if thread_root_id else event.event_id,
+                    extra_data=extra_data
+                )
+                if not isinstance(first_resp, RoomSendResponse):
+                    return response, first_resp
+                last_edit = time.monotonic()
+            elif time.monotonic() - last_edit >= global_config['stream_edit_interval']:
+                await client_helper.edit_text_in_room(room.room_id, first_resp.event_id, partial_response)
+                last_edit = time.monotonic()
+    except asyncio.CancelledError:
+        if isinstance(first_resp, RoomSendResponse):
+            await client_helper.edit_text_in_room(room.room_id, first_resp.event_id, f'{response.strip()}\n\n*(timed out)*', markdown_convert=True)
+        raise
+
+    if not first_resp:
+        # Nothing was generated.
+        return response, None
+    resp = await client_helper.edit_text_in_room(room.room_id, first_resp.event_id, response.strip().strip('\n'), markdown_convert=True)
+    if not isinstance(resp, RoomSendResponse):
+        # The message is already in the room, so don't send the response again.
+        logger.warning(f'Failed to send the complete response to event {event.event_id} in room {room.room_id}, the message in the room may be incomplete.')
+    return response, first_resp
@@ -1,26 +1,46 @@
 from anthropic import AsyncAnthropic
 from nio import RoomMessageImage
 
-from matrix_gpt.chat_functions import download_mxc
+from matrix_gpt.config import global_config
 from matrix_gpt.generate_clients.api_client import ApiClient
 from matrix_gpt.generate_clients.command_info import CommandInfo
-from matrix_gpt.image import process_image
+from matrix_gpt.image import get_image, IMAGE_MEDIA_TYPES
 
 
 class AnthropicApiClient(ApiClient):
+    _API_TYPE = 'anthropic'
+    _CHARS_PER_TOKEN = 3.5
+    _TOKENS_PER_IMAGE = 1100
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._system_prompt = None
 
-    def _create_client(self, base_url: str = None):
+    def _create_client(self, http_client, base_url: str = None, api_key: str = None):
         return AsyncAnthropic(
-            api_key=self._api_key
+            api_key=api_key or self._api_key,
+            http_client=http_client
         )
 
     def assemble_context(self, context: list, system_prompt: str = None, injected_system_prompt: str = None):
         assert not len(self._context)
         self._context = context
+        self._system_prompt = system_prompt
         self.verify_context()
 
+    def _fixed_tokens(self) -> int:
+        return int(len(self._system_prompt) // self._CHARS_PER_TOKEN) if self._system_prompt else 0
+
+    def trim_context(self, max_tokens: int) -> int:
+        removed = super().trim_context(max_tokens)
+        if removed:
+            # The context has to start with the user and alternate.
+            while len(self._context) > 1 and self._context[0]['role'] != self._HUMAN_NAME:
+                del self._context[0]
+                removed += 1
+            self.verify_context()
+        return removed
+
     def verify_context(self):
         """
         Verify that the context alternates between the human and assistant, inserting the opposite user type if it does not alternate correctly.
@@ -42,28 +62,48 @@ class AnthropicApiClient(ApiClient):
         assert role in [self._HUMAN_NAME, self._BOT_NAME]
         self._context.append(self.generate_text_msg(content, role))
 
-    async def append_img(self, img_event: RoomMessageImage, role: str):
+    async def generate_img_msg(self, img_event: RoomMessageImage, role: str):
         assert role in [self._HUMAN_NAME, self._BOT_NAME]
-        img_bytes = await download_mxc(img_event.url, self._client_helper.client)
-        encoded_image = await process_image(img_bytes, resize_px=784)
-        self._context.append({
+        image_format = global_config['anthropic']['image_format']
+        encoded_image = await get_image(img_event.url, self._client_helper.client, resize_px=784, image_format=image_format, quality=global_config['anthropic']['image_quality'])
+        return {
             "role": role,
             'content': [{
                 'type': 'image',
                 'source': {
                     'type': 'base64',
-                    'media_type': 'image/png',
+                    'media_type': IMAGE_MEDIA_TYPES[image_format],
                     'data': encoded_image
                 }
             }]
-        })
+        }
 
     async def generate(self, command_info: CommandInfo, matrix_gpt_data: str = None):
-        r = await self._create_client().messages.create(
-            model=command_info.model,
-            max_tokens=None if command_info.max_tokens == 0 else command_info.max_tokens,
-            temperature=command_info.temperature,
-            system='' if not command_info.system_prompt else command_info.system_prompt,
-            messages=self.context
-        )
+        limiter = self._get_rate_limiter()
+        await limiter.acquire(self._request_tokens(command_info))
+        with limiter.observe_errors():
+            raw = await self._get_client().messages.with_raw_response.create(
+                model=command_info.model,
+                max_tokens=None if command_info.max_tokens == 0 else command_info.max_tokens,
+                temperature=command_info.temperature,
+                system='' if not command_info.system_prompt else command_info.system_prompt,
+                messages=self.context
+            )
+        limiter.update(raw.headers)
+        r = raw.parse()
         return r.content[0].text, None
+
+    async def generate_stream(self, command_info: CommandInfo, matrix_gpt_data: str = None):
+        limiter = self._get_rate_limiter()
+        await limiter.acquire(self._request_tokens(command_info))
+        with limiter.observe_errors():
+            async with self._get_client().messages.stream(
+                    model=command_info.model,
+                    max_tokens=command_info.max_tokens,
+                    temperature=command_info.temperature,
+                    system='' if not command_info.system_prompt else command_info.system_prompt,
+                    messages=self.context
+            ) as stream:
+                limiter.update(stream.response.headers)
+                async for text in stream.text_stream:
+                    yield text
@@ -1,25 +1,60 @@
-from typing import Tuple
+import asyncio
+from typing import Tuple, AsyncIterator
 
 from nio import RoomMessageImage, MatrixRoom, Event
 
 from matrix_gpt import MatrixClientHelper
 from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.rate_limit import RateLimiter, rate_limiters
 
 
 class ApiClient:
     _HUMAN_NAME = 'user'
     _BOT_NAME = 'assistant'
+    _API_TYPE = None
 
-    def __init__(self, api_key: str, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event):
+    # Used to quickly estimate how many tokens the context is.
+    _CHARS_PER_TOKEN = 4
+    _TOKENS_PER_MSG = 4
+    _TOKENS_PER_IMAGE = 765
+    # How long a response is assumed to be for rate limiting when the command doesn't set `max_tokens`.
+    _DEFAULT_RESPONSE_TOKENS = 1024
+
+    def __init__(self, api_key: str, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event, client_manager=None):
         self._api_key = api_key
         self._client_helper = client_helper
         self._room = room
         self._event = event
+        self._client_manager = client_manager
         self._context = []
 
-    def _create_client(self, base_url: str = None):
+    def _create_client(self, http_client, base_url: str = None, api_key: str = None):
         raise NotImplementedError
 
+    def _get_client(self, base_url: str = None, api_key: str = None):
+        """
+        Get the shared SDK client for the API key and base URL from the `ApiClientManager`.
+        `api_key` overrides our API key, for endpoints that have their own.
+        """
+        api_key = api_key or self._api_key
+        if not self._client_manager:
+            return self._create_client(None, base_url, api_key)
+        return self._client_manager.get_sdk_client(self._API_TYPE, api_key, base_url, lambda http_client: self._create_client(http_client, base_url, api_key))
+
+    def _get_rate_limiter(self, base_url: str = None, api_key: str = None) -> RateLimiter:
+        """
+        Get the rate limiter for the API key and base URL, the same way `_get_client()` picks the SDK client.
+        """
+        return rate_limiters.get(self._API_TYPE, api_key or self._api_key, base_url)
+
+    def _request_tokens(self, command_info: CommandInfo) -> int:
+        """
+        Roughly estimate how many tokens a request will count against the rate limit: the context plus the longest
+        possible response.
+        """
+        response_tokens = command_info.max_tokens if command_info.max_tokens > 0 else self._DEFAULT_RESPONSE_TOKENS
+        return sum(self.estimate_tokens(msg) for msg in self._context) + self._fixed_tokens() + response_tokens
+
     def check_ignore_request(self):
         return False
 
@@ -33,12 +68,122 @@ class ApiClient:
     def append_msg(self, content: str, role: str):
         raise NotImplementedError
 
-    async def append_img(self, img_event: RoomMessageImage, role: str):
+    def append_summary(self, summary: str):
+        """
+        Append the summary of the messages in the thread before this point.
+        """
+        self._context.append(self.generate_text_msg(f'Summary of the earlier conversation:\n{summary}', self._HUMAN_NAME))
+
+    async def generate_img_msg(self, img_event: RoomMessageImage, role: str) -> dict:
         raise NotImplementedError
 
+    async def append_img(self, img_event: RoomMessageImage, role: str):
+        self.append_img_msg(await self.generate_img_msg(img_event, role))
+
+    def append_img_msg(self, img_msg: dict):
+        """
+        Append an image message created by `generate_img_msg()`.
+        """
+        self._context.append(img_msg)
+
+    def append_img_placeholder(self, img_event: RoomMessageImage, role: str):
+        """
+        Append a stand-in for an image that `fetch_images()` replaces with the real image message. It is counted
+        like any other image by `trim_context()`, so images that get trimmed are never downloaded.
+        """
+        self._context.append({'role': role, 'content': [{'type': 'image_placeholder', 'event': img_event}]})
+
+    async def fetch_images(self, concurrency: int):
+        """
+        Download and process the images that are still in the context all at once so that we only wait as long as
+        the slowest one takes.
+        """
+        placeholders = [i for i, msg in enumerate(self._context) if self._is_img_placeholder(msg)]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def generate_img_msg(msg):
+            async with semaphore:
+                return await self.generate_img_msg(msg['content'][0]['event'], msg['role'])
+
+        # If one image fails the rest are cancelled instead of being left to download in the background.
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(generate_img_msg(self._context[i])) for i in placeholders]
+        except ExceptionGroup as e:
+            raise e.exceptions[0]
+        for i, task in zip(placeholders, tasks):
+            self._context[i] = task.result()
+
+    def estimate_tokens(self, msg: dict) -> int:
+        """
+        Roughly estimate how many tokens a message in the context will use.
+        """
+        content = msg['content']
+        if isinstance(content, str):
+            return self._TOKENS_PER_MSG + int(len(content) // self._CHARS_PER_TOKEN)
+        tokens = self._TOKENS_PER_MSG
+        for part in content:
+            if part.get('type') == 'text':
+                tokens += int(len(part['text']) // self._CHARS_PER_TOKEN)
+            else:
+                tokens += self._TOKENS_PER_IMAGE
+        return tokens
+
+    def _fixed_tokens(self) -> int:
+        """
+        Tokens that are sent with every request but aren't part of the context.
+        """
+        return 0
+
+    @staticmethod
+    def _is_img_placeholder(msg: dict) -> bool:
+        return isinstance(msg['content'], list) and len(msg['content']) == 1 and msg['content'][0].get('type') == 'image_placeholder'
+
+    @staticmethod
+    def _is_img_msg(msg: dict) -> bool:
+        return isinstance(msg['content'], list) and any(part.get('type') != 'text' for part in msg['content'])
+
+    def trim_context(self, max_tokens: int) -> int:
+        """
+        Trim the context so that it fits in `max_tokens`. Older images are removed first, then the oldest messages.
+        System messages and the messages in the current turn (everything after the bot's last reply) are always kept.
+        Returns the number of messages that were removed.
+        """
+        sizes = [self.estimate_tokens(msg) for msg in self._context]
+        total = sum(sizes) + self._fixed_tokens()
+        if total <= max_tokens:
+            return 0
+
+        current_turn = len(self._context) - 1
+        while current_turn > 0 and self._context[current_turn - 1]['role'] != self._BOT_NAME:
+            current_turn -= 1
+        removable = [i for i in range(current_turn) if self._context[i]['role'] != 'system']
+
+        removed = set()
+        for i in removable:
+            if self._is_img_msg(self._context[i]):
+                removed.add(i)
+                total -= sizes[i]
+        for i in removable:
+            if total <= max_tokens:
+                break
+            if i not in removed:
+                removed.add(i)
+                total -= sizes[i]
+
+        self._context = [msg for i, msg in enumerate(self._context) if i not in removed]
+        return len(removed)
+
     async def generate(self, command_info: CommandInfo, matrix_gpt_data: str = None) -> Tuple[str, dict | None]:
         raise NotImplementedError
 
+    async def generate_stream(self, command_info: CommandInfo, matrix_gpt_data: str = None) -> AsyncIterator[str]:
+        """
+        Yield the response text as it is generated.
+        """
+        raise NotImplementedError
+        yield
+
     @property
     def context(self):
         return self._context.copy()
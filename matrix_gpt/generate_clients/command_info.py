@@ -1,8 +1,16 @@
+import copy
+
+from matrix_gpt.acl import compile_acl
 from matrix_gpt.config import global_config, VALID_API_TYPES
 
 
 class CommandInfo:
-    def __init__(self, trigger: str, api_type: str, model: str, max_tokens: int, temperature: float, allowed_to_chat: list, allowed_to_thread: list, allowed_to_invite: list, system_prompt: str, injected_system_prompt: str, api_base: str = None, vision: bool = False, help: str = None):
+    """
+    The settings for a command. One instance per command is created when the config is validated and shared by
+    every request, so instances can't be modified. Use `replace()` to get a modified copy.
+    """
+
+    def __init__(self, trigger: str, api_type: str, model: str, max_tokens: int, temperature: float, allowed_to_chat: list, allowed_to_thread: list, allowed_to_invite: list, system_prompt: str, injected_system_prompt: str, api_base: str = None, vision: bool = False, help: str = None, stream: bool = False, context_window: int = 0, context_reserve: int = 0, history_mode: str = 'full', endpoints: list = None, routing: str = 'least_outstanding', api_key: str = None):
         self.trigger = trigger
         assert api_type in VALID_API_TYPES
         self.api_type = api_type
@@ -14,15 +22,55 @@ class CommandInfo:
         self.api_base = api_base
         self.vision = vision
         self.help = help
+        self.stream = stream
+        self.context_window = context_window
+        self.context_reserve = context_reserve
+        self.history_mode = history_mode
+        self.endpoints = tuple(endpoints) if endpoints else ()
+        self.routing = routing
+        # Overrides the API key of the API type. Set for each endpoint in a pool.
+        self.api_key = api_key
 
-        self.allowed_to_chat = allowed_to_chat
+        self.allowed_to_chat = tuple(allowed_to_chat)
         if not len(self.allowed_to_chat):
-            self.allowed_to_chat = global_config['allowed_to_chat']
+            self.allowed_to_chat = tuple(global_config['allowed_to_chat'])
 
-        self.allowed_to_thread = allowed_to_thread
+        self.allowed_to_thread = tuple(allowed_to_thread)
         if not len(self.allowed_to_thread):
-            self.allowed_to_thread = global_config['allowed_to_thread']
+            self.allowed_to_thread = tuple(global_config['allowed_to_thread'])
 
-        self.allowed_to_invite = allowed_to_invite
+        self.allowed_to_invite = tuple(allowed_to_invite)
         if not len(self.allowed_to_invite):
-            self.allowed_to_invite = global_config['allowed_to_invite']
+            self.allowed_to_invite = tuple(global_config['allowed_to_invite'])
+
+        self.chat_acl = compile_acl(self.allowed_to_chat)
+        self.thread_acl = compile_acl(self.allowed_to_thread)
+        # Who can start a thread with this command.
+        self.command_acl = compile_acl(self.allowed_to_chat + tuple(global_config['allowed_to_chat']))
+
+        self._frozen = True
+
+    @property
+    def scheduler_key(self) -> tuple:
+        """
+        Commands that send requests to the same endpoints share a queue in the scheduler.
+        """
+        if self.endpoints:
+            return self.api_type, tuple(sorted(e['url'] for e in self.endpoints))
+        return self.api_type, self.api_base
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'CommandInfo is immutable, use replace() to change {key}')
+        super().__setattr__(key, value)
+
+    def replace(self, **changes) -> 'CommandInfo':
+        """
+        Get a copy of this command with some settings changed.
+        """
+        new = copy.copy(self)
+        for key, value in changes.items():
+            if not hasattr(self, key):
+                raise AttributeError(f'CommandInfo has no setting {key}')
+            object.__setattr__(new, key, value)
+        return new
@@ -1,6 +1,5 @@
 import json
 import re
-import time
 from urllib.parse import urlparse
 
 from cryptography.fernet import Fernet
@@ -11,6 +10,7 @@ from sydney.exceptions import ThrottledRequestException
 from matrix_gpt.config import global_config
 from matrix_gpt.generate_clients.api_client import ApiClient
 from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.retry import sleep_backoff
 
 """
 This was written with sydney.py==0.20.4 but requirements.txt has not locked in a version because Bing's API may change.
@@ -32,17 +32,19 @@ def decrypt_string(token: str) -> bytes:
 
 
 class CopilotClient(ApiClient):
+    _API_TYPE = 'copilot'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def _create_client(self, api_base: str = None):
+    def _create_client(self, http_client, api_base: str = None, api_key: str = None):
         return None
 
     def append_msg(self, content: str, role: str):
         assert role in [self._HUMAN_NAME, self._BOT_NAME]
         self._context.append({'role': role, 'content': content})
 
-    async def append_img(self, img_event: RoomMessageImage, role: str):
+    async def generate_img_msg(self, img_event: RoomMessageImage, role: str):
         raise NotImplementedError
 
     # def check_ignore_request(self):
@@ -76,7 +78,8 @@ class CopilotClient(ApiClient):
                     response = dict(await sydney.ask(self._context[-1]['content'], citations=True, raw=True))
                     break
                 except ThrottledRequestException:
-                    time.sleep(10)
+                    if i < 2:
+                        await sleep_backoff(i, base=10)
             if not response:
                 # If this happens you should first try to change your cookies.
                 # Otherwise, you've used all your credits for today.
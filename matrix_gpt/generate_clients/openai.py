@@ -1,45 +1,53 @@
 from nio import RoomMessageImage
 from openai import AsyncOpenAI
 
-from matrix_gpt.chat_functions import download_mxc
 from matrix_gpt.config import global_config
 from matrix_gpt.generate_clients.api_client import ApiClient
 from matrix_gpt.generate_clients.command_info import CommandInfo
-from matrix_gpt.image import process_image
+from matrix_gpt.image import get_image, IMAGE_MEDIA_TYPES
 
 
 class OpenAIClient(ApiClient):
+    _API_TYPE = 'openai'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def _create_client(self, api_base: str = None):
+    def _create_client(self, http_client, api_base: str = None, api_key: str = None):
         return AsyncOpenAI(
-            api_key=self._api_key,
-            base_url=api_base
+            api_key=api_key or self._api_key,
+            base_url=api_base,
+            http_client=http_client
         )
 
-    def append_msg(self, content: str, role: str):
+    def generate_text_msg(self, content: str, role: str):
         assert role in [self._HUMAN_NAME, self._BOT_NAME]
-        self._context.append({'role': role, 'content': content})
+        return {'role': role, 'content': content}
+
+    def append_msg(self, content: str, role: str):
+        self._context.append(self.generate_text_msg(content, role))
 
-    async def append_img(self, img_event: RoomMessageImage, role: str):
+    def append_summary(self, summary: str):
+        self._context.append({'role': 'system', 'content': f'Summary of the earlier conversation:\n{summary}'})
+
+    async def generate_img_msg(self, img_event: RoomMessageImage, role: str):
         """
         We crop the largest dimension of the image to 512px and then let the AI decide
         if it should use low or high res analysis.
         """
         assert role in [self._HUMAN_NAME, self._BOT_NAME]
-        img_bytes = await download_mxc(img_event.url, self._client_helper.client)
-        encoded_image = await process_image(img_bytes, resize_px=512)
-        self._context.append({
+        image_format = global_config['openai']['image_format']
+        encoded_image = await get_image(img_event.url, self._client_helper.client, resize_px=512, image_format=image_format, quality=global_config['openai']['image_quality'])
+        return {
             "role": role,
             'content': [{
                 'type': 'image_url',
                 'image_url': {
-                    'url': f"data:image/png;base64,{encoded_image}",
+                    'url': f"data:{IMAGE_MEDIA_TYPES[image_format]};base64,{encoded_image}",
                     'detail': 'auto'
                 }
             }]
-        })
+        }
 
     def assemble_context(self, context: list, system_prompt: str = None, injected_system_prompt: str = None):
         assert not len(self._context)
@@ -54,11 +62,33 @@ class OpenAIClient(ApiClient):
             self._context.insert(-1, {"role": "system", "content": injected_system_prompt})
 
     async def generate(self, command_info: CommandInfo, matrix_gpt_data: str = None):
-        r = await self._create_client(command_info.api_base).chat.completions.create(
-            model=command_info.model,
-            messages=self._context,
-            temperature=command_info.temperature,
-            timeout=global_config['response_timeout'],
-            max_tokens=None if command_info.max_tokens == 0 else command_info.max_tokens,
-        )
+        limiter = self._get_rate_limiter(command_info.api_base, command_info.api_key)
+        await limiter.acquire(self._request_tokens(command_info))
+        with limiter.observe_errors():
+            raw = await self._get_client(command_info.api_base, command_info.api_key).chat.completions.with_raw_response.create(
+                model=command_info.model,
+                messages=self._context,
+                temperature=command_info.temperature,
+                timeout=global_config['response_timeout'],
+                max_tokens=None if command_info.max_tokens == 0 else command_info.max_tokens,
+            )
+        limiter.update(raw.headers)
+        r = raw.parse()
         return r.choices[0].message.content, None
+
+    async def generate_stream(self, command_info: CommandInfo, matrix_gpt_data: str = None):
+        limiter = self._get_rate_limiter(command_info.api_base, command_info.api_key)
+        await limiter.acquire(self._request_tokens(command_info))
+        with limiter.observe_errors():
+            stream = await self._get_client(command_info.api_base, command_info.api_key).chat.completions.create(
+                model=command_info.model,
+                messages=self._context,
+                temperature=command_info.temperature,
+                timeout=global_config['response_timeout'],
+                max_tokens=None if command_info.max_tokens == 0 else command_info.max_tokens,
+                stream=True,
+            )
+        limiter.update(stream.response.headers)
+        async for chunk in stream:
+            if len(chunk.choices) and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
@@ -1,5 +1,4 @@
 import logging
-import time
 import traceback
 
 from nio import RoomMessageText, MatrixRoom, MegolmEvent, InviteMemberEvent, JoinError
@@ -10,6 +9,9 @@ from matrix_gpt.chat_functions import is_this_our_thread, get_thread_content, ch
 from matrix_gpt.config import global_config
 from matrix_gpt.generate import generate_ai_response
 from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.retrieval import retrieval_memory
+from matrix_gpt.retry import retry_matrix
+from matrix_gpt.summary import thread_summaries
 
 logger = logging.getLogger('MatrixGPT').getChild('HandleActions')
 
@@ -38,20 +40,18 @@ async def do_reply_threaded_msg(client_helper: MatrixClientHelper, room: MatrixR
     if not is_our_thread:  # or room.member_count == 2
         return
 
-    if not check_authorized(requestor_event.sender, command_info.allowed_to_chat):
+    if not check_authorized(requestor_event.sender, command_info.chat_acl):
         await client_helper.react_to_event(room.room_id, requestor_event.event_id, '🚫', extra_error='Not allowed to chat.' if global_config['send_extra_messages'] else None)
         return
-    if not check_authorized(requestor_event.sender, command_info.allowed_to_thread):
+    if not check_authorized(requestor_event.sender, command_info.thread_acl):
         await client_helper.react_to_event(room.room_id, requestor_event.event_id, '🚫', extra_error='Not allowed to thread.' if global_config['send_extra_messages'] else None)
         return
 
     try:
-        # TODO: sync this with redis so that we don't clear the typing state if another response is also processing
-        await client.room_typing(room.room_id, typing_state=True, timeout=30000)
+        await client_helper.typing.start(room.room_id)
 
         thread_content = await get_thread_content(client, room, requestor_event)
-        api_client = api_client_helper.get_client(command_info.api_type, client_helper, room, requestor_event)
-        matrix_gpt_data = {}
+        api_client = api_client_helper.get_client(command_info.api_type, client_helper, room, requestor_event, command_info)
         for event in thread_content:
             if isinstance(event, MegolmEvent):
                 await client_helper.send_text_to_room(
@@ -62,20 +62,34 @@ async def do_reply_threaded_msg(client_helper: MatrixClientHelper, room: MatrixR
                     thread_root_id=thread_content[0].event_id
                 )
                 logger.critical(f'Decryption failure for event {event.event_id} in room {room.room_id}')
-                await client.room_typing(room.room_id, typing_state=False, timeout=1000)
                 return
-            else:
-                role = api_client.BOT_NAME if event.sender == client.user_id else api_client.HUMAN_NAME
-                if isinstance(event, RoomMessageText):
-                    thread_msg = event.body.strip().strip('\n')
-                    api_client.append_msg(
-                        role=role,
-                        content=thread_msg if not check_command_prefix(thread_msg)[0] else thread_msg[len(command_info.trigger):].strip(),
-                    )
-                    if event.source.get('content', {}).get('m.matrixgpt', {}).get('data'):
-                        matrix_gpt_data = event.source['content']['m.matrixgpt']['data']
-                elif command_info.vision:
-                    await api_client.append_img(event, role)
+
+        # Pick which messages in the thread to send.
+        checkpoint = None
+        history = thread_content
+        if command_info.history_mode == 'summary':
+            # Only send the messages after the newest summary of the thread.
+            checkpoint = thread_summaries.get_checkpoint(room.room_id, thread_content, client.user_id)
+            if checkpoint:
+                api_client.append_summary(checkpoint[0])
+                history = thread_content[checkpoint[1]:]
+        elif command_info.history_mode == 'retrieval':
+            history = await retrieval_memory.select(room.room_id, thread_content, requestor_event.body)
+
+        matrix_gpt_data = {}
+        for event in history:
+            role = api_client.BOT_NAME if event.sender == client.user_id else api_client.HUMAN_NAME
+            if isinstance(event, RoomMessageText):
+                thread_msg = event.body.strip().strip('\n')
+                api_client.append_msg(
+                    role=role,
+                    content=thread_msg if not check_command_prefix(thread_msg)[0] else thread_msg[len(command_info.trigger):].strip(),
+                )
+                if event.source.get('content', {}).get('m.matrixgpt', {}).get('data'):
+                    matrix_gpt_data = event.source['content']['m.matrixgpt']['data']
+            elif command_info.vision:
+                # Downloaded by `generate_ai_response()` once it knows which images fit in the context window.
+                api_client.append_img_placeholder(event, role)
 
         await generate_ai_response(
             client_helper=client_helper,
@@ -86,10 +100,15 @@ async def do_reply_threaded_msg(client_helper: MatrixClientHelper, room: MatrixR
             thread_root_id=thread_content[0].event_id,
             matrix_gpt_data=matrix_gpt_data
         )
+
+        if command_info.history_mode == 'summary':
+            thread_summaries.maybe_summarize(client_helper, room, requestor_event, command_info, thread_content, checkpoint)
     except:
         logger.error(traceback.format_exc())
         await client_helper.react_to_event(room.room_id, event.event_id, '❌')
         raise
+    finally:
+        await client_helper.typing.stop(room.room_id)
 
 
 async def do_join_channel(client_helper: MatrixClientHelper, room: MatrixRoom, event: InviteMemberEvent):
@@ -99,16 +118,11 @@ async def do_join_channel(client_helper: MatrixClientHelper, room: MatrixRoom, e
 
     # Attempt to join 3 times before giving up.
     client = client_helper.client
-    for attempt in range(3):
-        result = await client.join(room.room_id)
-        if isinstance(result, JoinError):
-            logger.error(f'Error joining room {room.room_id} (attempt {attempt}): "{result.message}"')
-            time.sleep(5)
-        else:
-            logger.info(f'Joined via invite: {room.room_id}')
-            return
-    else:
+    result = await retry_matrix(lambda: client.join(room.room_id), attempts=3, base=5, description=f'Joining room {room.room_id}')
+    if isinstance(result, JoinError):
         logger.error(f'Unable to join room: {room.room_id}')
+    else:
+        logger.info(f'Joined via invite: {room.room_id}')
 
 
 async def sound_off(room: MatrixRoom, event: RoomMessageText, client_helper: MatrixClientHelper):
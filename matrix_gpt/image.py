@@ -1,15 +1,65 @@
 import asyncio
 import base64
+import hashlib
 import io
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
 
 from PIL import Image
+from nio import AsyncClient
 
+from matrix_gpt.chat_functions import download_mxc
+from matrix_gpt.config import global_config
 
-async def process_image(source_bytes: bytes, resize_px: int):
-    loop = asyncio.get_event_loop()
-    image = await loop.run_in_executor(None, Image.open, io.BytesIO(source_bytes))
+logger = logging.getLogger('MatrixGPT').getChild('Image')
+
+
+IMAGE_MEDIA_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def _get_executor() -> ProcessPoolExecutor | None:
+    """
+    Image work is CPU-bound so it runs in a dedicated process pool instead of fighting the event loop for the GIL.
+    Setting `image.process_workers` to `0` uses the default thread pool instead.
+    The workers are started by a fork server because forking the bot, which has threads running, can deadlock them.
+    """
+    global _executor
+    workers = global_config['image']['process_workers']
+    if workers < 1:
+        return None
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _process_image(source_bytes: bytes, resize_px: int, image_format: str, quality: int) -> bytes:
+    image = Image.open(io.BytesIO(source_bytes))
     width, height = image.size
 
+    if image.format == 'JPEG' and min(width, height) >= resize_px * 2:
+        # Have the JPEG decoder scale the image down while decoding. It will stay at least as large as what we resize to.
+        scale = resize_px / min(width, height)
+        image.draft('RGB', (int(width * scale), int(height * scale)))
+        width, height = image.size
+
     if min(width, height) > resize_px:
         if width < height:
             new_width = resize_px
@@ -17,9 +67,187 @@ async def process_image(source_bytes: bytes, resize_px: int):
         else:
             new_height = resize_px
             new_width = int((width / height) * new_height)
-        image = await loop.run_in_executor(None, image.resize, (new_width, new_height))
+        image = image.resize((new_width, new_height))
+
+    if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
 
     byte_arr = io.BytesIO()
-    await loop.run_in_executor(None, image.save, byte_arr, 'PNG')
-    image_bytes = byte_arr.getvalue()
+    if image_format == 'png':
+        image.save(byte_arr, 'PNG')
+    else:
+        image.save(byte_arr, image_format.upper(), quality=quality)
+    return byte_arr.getvalue()
+
+
+async def process_image(source_bytes: bytes, resize_px: int, image_format: str = 'png', quality: int = 85) -> str:
+    global _executor
+    loop = asyncio.get_event_loop()
+    executor = _get_executor()
+    try:
+        image_bytes = await loop.run_in_executor(executor, _process_image, source_bytes, resize_px, image_format, quality)
+    except BrokenProcessPool:
+        # A worker died (like from running out of memory on a huge image). Start a new pool for the next image.
+        logger.error('An image worker process died, restarting the process pool')
+        if _executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+        raise
     return base64.b64encode(image_bytes).decode('utf-8')
+
+
+class ImageCache:
+    """
+    Caches the base64 payloads of processed images so that images in a thread are only downloaded and processed once.
+    Payloads are kept in memory up to `image_cache.memory_bytes` and, if `image_cache.disk` is enabled,
+    also written to the store directory up to `image_cache.disk_bytes`. Both tiers evict the least-recently-used images first.
+    """
+
+    def __init__(self):
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._pruning = False
+        self._pending = {}
+
+    @property
+    def _config(self):
+        return global_config['image_cache']
+
+    @property
+    def _disk_path(self) -> Path:
+        return Path(global_config['store_path']).absolute().expanduser().resolve() / 'image-cache'
+
+    async def get_or_create(self, key: str, create) -> str:
+        """
+        Get the payload for `key`, calling the coroutine function `create` to produce it if it isn't cached.
+        Concurrent calls for the same key share a single `create()`.
+        """
+        encoded = self._memory_get(key)
+        if encoded is not None:
+            return encoded
+        task = self._pending.get(key)
+        if task is None:
+            # Run it in its own task so that cancelling the caller that started it doesn't cancel it for everyone else.
+            task = self._pending[key] = asyncio.create_task(self._create(key, create))
+            task.add_done_callback(lambda t: self._create_done(key, t))
+        return await asyncio.shield(task)
+
+    async def _create(self, key: str, create) -> str:
+        encoded = await self._disk_get(key)
+        if encoded is None:
+            encoded = await create()
+            await self._disk_put(key, encoded)
+        self._memory_put(key, encoded)
+        return encoded
+
+    def _create_done(self, key: str, task: asyncio.Task):
+        if self._pending.get(key) is task:
+            del self._pending[key]
+        if not task.cancelled():
+            task.exception()  # Don't warn about the exception if every caller stopped waiting on it.
+
+    def _memory_get(self, key: str) -> str | None:
+        encoded = self._memory.get(key)
+        if encoded is not None:
+            self._memory.move_to_end(key)
+        return encoded
+
+    def _memory_put(self, key: str, encoded: str):
+        if len(encoded) > self._config['memory_bytes']:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory[key])
+        self._memory[key] = encoded
+        self._memory_size += len(encoded)
+        while self._memory_size > self._config['memory_bytes']:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _disk_file(self, key: str) -> Path:
+        return self._disk_path / hashlib.sha256(key.encode()).hexdigest()
+
+    async def _disk_get(self, key: str) -> str | None:
+        if not self._config['disk']:
+            return None
+        return await asyncio.get_event_loop().run_in_executor(None, self._read_file, self._disk_file(key))
+
+    async def _disk_put(self, key: str, encoded: str):
+        if not self._config['disk']:
+            return
+        # The size is only changed here on the event loop, the executor threads just report what they changed.
+        loop = asyncio.get_event_loop()
+        if self._disk_size is None:
+            size = await loop.run_in_executor(None, self._scan_disk, self._disk_path)
+            if self._disk_size is None:
+                self._disk_size = size
+        self._disk_size += await loop.run_in_executor(None, self._write_file, self._disk_file(key), encoded)
+        if self._disk_size > self._config['disk_bytes'] and not self._pruning:
+            self._pruning = True
+            try:
+                self._disk_size = await loop.run_in_executor(None, self._prune_disk, self._disk_path, self._config['disk_bytes'] * 0.9)
+            finally:
+                self._pruning = False
+
+    @staticmethod
+    def _read_file(path: Path) -> str | None:
+        try:
+            encoded = path.read_text()
+            os.utime(path)  # Mark it as recently used.
+            return encoded
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _scan_disk(directory: Path) -> int:
+        if not directory.exists():
+            return 0
+        return sum(f.stat().st_size for f in directory.iterdir() if f.is_file())
+
+    @staticmethod
+    def _write_file(path: Path, encoded: str) -> int:
+        """
+        Returns how many bytes the cache grew by. Overwriting a file only adds the difference.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(encoded)
+        os.replace(tmp_path, path)
+        return len(encoded) - old_size
+
+    @staticmethod
+    def _prune_disk(directory: Path, target: float) -> int:
+        """
+        Delete the least-recently-used files until the cache is under `target` bytes. Returns the new size.
+        """
+        files = sorted((f for f in directory.iterdir() if f.is_file()), key=lambda f: f.stat().st_mtime)
+        disk_size = sum(f.stat().st_size for f in files)
+        for f in files:
+            if disk_size <= target:
+                break
+            size = f.stat().st_size
+            f.unlink(missing_ok=True)
+            disk_size -= size
+        logger.debug(f'Pruned the image cache to {disk_size} bytes')
+        return disk_size
+
+
+image_cache = ImageCache()
+
+
+async def get_image(url: str, client: AsyncClient, resize_px: int, image_format: str = 'png', quality: int = 85) -> str:
+    """
+    Download and process an image, returning the base64 payload. Results are cached by mxc URL and output settings.
+    """
+
+    async def create():
+        img_bytes = await download_mxc(url, client)
+        return await process_image(img_bytes, resize_px, image_format, quality)
+
+    return await image_cache.get_or_create(f'{url}:{resize_px}:{image_format}:{quality}', create)
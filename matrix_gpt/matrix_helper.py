@@ -1,7 +1,6 @@
 import asyncio
-import json
 import logging
-import os
+import time
 from pathlib import Path
 from typing import Union, Optional
 
@@ -9,6 +8,16 @@ from markdown import markdown
 from nio import AsyncClient, AsyncClientConfig, LoginError, Response, ErrorResponse, RoomSendResponse, SendRetryError, SyncError
 from nio.responses import LoginResponse, SyncResponse
 
+from .background import TypingManager, ReadMarkerManager
+from .config import global_config
+from .metrics import metrics
+from .send_queue import send_queue, PRIORITY_LOW
+from .state_store import StateStore
+
+
+# The room events the bot handles. Images are `m.room.message` too.
+SYNC_EVENT_TYPES = ['m.room.message', 'm.room.encrypted', 'm.reaction']
+
 
 class MatrixClientHelper:
     """
@@ -16,6 +25,7 @@ class MatrixClientHelper:
     """
 
     # Encryption is disabled because it's handled by Pantalaimon.
+    # nio doesn't retry rate-limited requests, the send queue does that.
     client_config = AsyncClientConfig(max_limit_exceeded=0, max_timeouts=0, store_sync_tokens=True, encryption_enabled=False)
 
     def __init__(self, user_id: str, passwd: str, homeserver: str, store_path: str, device_id: str):
@@ -31,16 +41,23 @@ class MatrixClientHelper:
         self.auth_file = self.store_path / (device_id.lower() + '.json')
         self.device_name = device_id
         self.client: AsyncClient = AsyncClient(homeserver=self.homeserver, user=self.user_id, config=self.client_config, device_id=device_id)
+        self.typing = TypingManager(self.client)
+        self.read_markers = ReadMarkerManager(self._send_read_marker, global_config['read_markers']['debounce'])
+        metrics.register('read_markers', self.read_markers.stats)
+        self.state = StateStore(self.auth_file)
+        self._sync_token = None
+        self._sync_token_ts = None
+        self._checkpoint_task = None
         self.logger = logging.getLogger('MatrixGPT').getChild('MatrixClientHelper')
 
     async def login(self) -> tuple[bool, LoginResponse | LoginError | None]:
         try:
             # If there are no previously-saved credentials, we'll use the password.
-            if not os.path.exists(self.auth_file):
+            if not self.state.auth:
                 self.logger.info('Using username/password')
                 resp = await self.client.login(self.passwd, device_name=self.device_name)
                 if isinstance(resp, LoginResponse):
-                    self._write_details_to_disk(resp)
+                    await self._save_login(resp)
                     return True, resp
                 else:
                     return False, resp
@@ -48,7 +65,7 @@ class MatrixClientHelper:
                 # Otherwise the config file exists, so we'll use the stored credentials.
                 self.logger.info('Using cached credentials')
 
-                auth_details = self._read_details_from_disk()['auth']
+                auth_details = self.state.auth
                 client = AsyncClient(auth_details["homeserver"])
                 client.access_token = auth_details["access_token"]
                 client.user_id = auth_details["user_id"]
@@ -56,51 +73,82 @@ class MatrixClientHelper:
 
                 resp = await self.client.login(self.passwd, device_name=self.device_name)
                 if isinstance(resp, LoginResponse):
-                    self._write_details_to_disk(resp)
+                    await self._save_login(resp)
                     return True, resp
                 else:
                     return False, resp
         except Exception:
             raise
 
-    async def sync(self) -> SyncResponse | SyncError:
-        last_sync = self._read_details_from_disk().get('extra', {}).get('last_sync')
-        response = await self.client.sync(timeout=10000, full_state=True, since=last_sync)
+    async def sync(self, timeline_limit: int = None) -> SyncResponse | SyncError:
+        last_sync = self._sync_token or self.state.sync_token
+        response = await self.client.sync(timeout=10000, full_state=global_config['sync']['full_state'], since=last_sync, sync_filter=self.sync_filter(timeline_limit))
         if isinstance(response, SyncError):
             raise Exception(response)
-        self._write_details_to_disk(extra_data={'last_sync': response.next_batch})
+        self._set_sync_token(response.next_batch)
+        self.save_sync_token()
         return response
 
-    def run_sync_in_bg(self):
+    @staticmethod
+    def sync_filter(timeline_limit: int = None) -> dict:
+        """
+        A sync filter that only asks for the events the bot handles. Invites are always sent by the homeserver
+        since they aren't part of the room timeline.
+        """
+        config = global_config['sync']
+        if timeline_limit is None:
+            timeline_limit = config['timeline_limit']
+        timeline = {
+            'types': SYNC_EVENT_TYPES,
+            'lazy_load_members': config['lazy_load_members'],
+        }
+        if timeline_limit is not None:
+            timeline['limit'] = timeline_limit
+        return {
+            'presence': {'not_types': ['*']},
+            'account_data': {'not_types': ['*']},
+            'room': {
+                'timeline': timeline,
+                'state': {'lazy_load_members': config['lazy_load_members']},
+                'ephemeral': {'not_types': ['*']},
+                'account_data': {'not_types': ['*']},
+            },
+        }
+
+    def start_sync_checkpointing(self):
         """
-        Run a sync in the background to update the `last_sync` value every 3 minutes.
+        Record the sync token from every sync the client does and save it every `sync.checkpoint_interval` seconds.
         """
-        asyncio.create_task(self._do_run_sync_in_bg())
+        if self._checkpoint_task is None:
+            self.client.add_response_callback(self._on_sync_response, SyncResponse)
+            self._checkpoint_task = asyncio.create_task(self._checkpoint_sync_token())
+
+    async def _on_sync_response(self, response: SyncResponse):
+        self._set_sync_token(response.next_batch)
 
-    async def _do_run_sync_in_bg(self):
+    def _set_sync_token(self, token: str):
+        # Remember when we got the token, not when it is saved. Catching up skips messages sent before this time.
+        self._sync_token = token
+        self._sync_token_ts = int(time.time() * 1000)
+
+    async def _checkpoint_sync_token(self):
         while True:
-            await self.sync()
-            await asyncio.sleep(180)  # 3 minutes
-
-    def _read_details_from_disk(self):
-        if not self.auth_file.exists():
-            return {'auth': {}, 'extra': {}}
-        with open(self.auth_file, 'r') as f:
-            return json.load(f)
-
-    def _write_details_to_disk(self, resp: LoginResponse = None, extra_data: dict = None) -> None:
-        data = self._read_details_from_disk()
-        if resp:
-            data['auth'] = {
-                'homeserver': self.homeserver,
-                'user_id': resp.user_id,
-                'device_id': resp.device_id,
-                'access_token': resp.access_token,
-            }
-        if extra_data:
-            data['extra'] = extra_data
-        with open(self.auth_file, 'w') as f:
-            json.dump(data, f, indent=4)
+            await asyncio.sleep(global_config['sync']['checkpoint_interval'])
+            try:
+                self.save_sync_token()
+            except Exception as e:
+                self.logger.error(f'Failed to save the sync token: {e}')
+
+    def save_sync_token(self):
+        """
+        Save the latest sync token. It is written to disk in the background.
+        """
+        if self._sync_token:
+            self.state.set_sync_token(self._sync_token, self._sync_token_ts)
+
+    async def _save_login(self, resp: LoginResponse):
+        self.state.set_auth(self.homeserver, resp.user_id, resp.device_id, resp.access_token)
+        await self.state.flush()
 
     async def react_to_event(self, room_id: str, event_id: str, reaction_text: str, extra_error: str = False, extra_msg: str = False) -> Union[Response, ErrorResponse]:
         content = {
@@ -115,7 +163,11 @@ class MatrixClientHelper:
             content["m.matrixbot"]["error"] = str(extra_error)
         if extra_msg:
             content["m.matrixbot"]["msg"] = str(extra_msg)
-        return await self.client.room_send(room_id, "m.reaction", content, ignore_unverified_devices=True)
+        return await send_queue.send(
+            room_id,
+            lambda: self.client.room_send(room_id, "m.reaction", content, ignore_unverified_devices=True),
+            PRIORITY_LOW
+        )
 
     async def send_text_to_room(self, room_id: str, message: str, notice: bool = False,
                                 markdown_convert: bool = False, reply_to_event_id: Optional[str] = None,
@@ -171,6 +223,51 @@ class MatrixClientHelper:
             if extra_data:
                 content["m.matrixgpt"].update(extra_data)
         try:
-            return await self.client.room_send(room_id, "m.room.message", content, ignore_unverified_devices=True)
+            return await send_queue.send(room_id, lambda: self.client.room_send(room_id, "m.room.message", content, ignore_unverified_devices=True))
         except SendRetryError:
             self.logger.exception(f"Unable to send message response to {room_id}")
+
+    async def edit_text_in_room(self, room_id: str, event_id: str, message: str, notice: bool = False, markdown_convert: bool = False) -> Union[RoomSendResponse, ErrorResponse]:
+        """Replace the content of a message we sent earlier.
+
+        Args:
+            room_id: The ID of the room the message is in.
+            event_id: The ID of the message to edit.
+            message: The new message content.
+            notice: Whether the message should be sent with an "m.notice" message type.
+            markdown_convert: Whether to convert the message content to markdown.
+
+        Returns:
+            A RoomSendResponse if the request was successful, else an ErrorResponse.
+
+        """
+        msgtype = "m.notice" if notice else "m.text"
+        new_content = {"msgtype": msgtype, "format": "org.matrix.custom.html", "body": message}
+        if markdown_convert:
+            new_content["formatted_body"] = markdown(message, extensions=['fenced_code'])
+
+        content = {
+            "msgtype": msgtype,
+            "body": f"* {message}",
+            "m.new_content": new_content,
+            "m.relates_to": {
+                "rel_type": "m.replace",
+                "event_id": event_id
+            }
+        }
+        try:
+            return await send_queue.send(room_id, lambda: self.client.room_send(room_id, "m.room.message", content, ignore_unverified_devices=True))
+        except SendRetryError:
+            self.logger.exception(f"Unable to edit message {event_id} in {room_id}")
+
+    async def redact_event(self, room_id: str, event_id: str) -> Union[Response, ErrorResponse]:
+        return await send_queue.send(room_id, lambda: self.client.room_redact(room_id, event_id), PRIORITY_LOW)
+
+    def mark_read(self, room_id: str, event_id: str):
+        """
+        Mark an event as read. Read markers are sent in the background and combined per room.
+        """
+        self.read_markers.mark(room_id, event_id)
+
+    async def _send_read_marker(self, room_id: str, event_id: str) -> Union[Response, ErrorResponse]:
+        return await send_queue.send(room_id, lambda: self.client.room_read_markers(room_id, event_id, event_id), PRIORITY_LOW)
@@ -0,0 +1,32 @@
+import asyncio
+import json
+import logging
+from typing import Callable, Dict
+
+logger = logging.getLogger('MatrixGPT').getChild('Metrics')
+
+
+class Metrics:
+    """
+    A registry of functions that report the state of the bot's subsystems.
+    """
+
+    def __init__(self):
+        self._sources: Dict[str, Callable[[], dict]] = {}
+
+    def register(self, name: str, func: Callable[[], dict]):
+        self._sources[name] = func
+
+    def snapshot(self) -> dict:
+        return {name: func() for name, func in self._sources.items()}
+
+    async def log_forever(self, interval: int):
+        """
+        Log a snapshot of all the metrics every `interval` seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(json.dumps(self.snapshot()))
+
+
+metrics = Metrics()
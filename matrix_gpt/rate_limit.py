@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from matrix_gpt.config import global_config
+from matrix_gpt.metrics import metrics
+
+logger = logging.getLogger('MatrixGPT').getChild('RateLimit')
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """
+    Parse OpenAI's reset times, like `1s`, `6m0s`, or `20ms`.
+    """
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def _parse_timestamp(value: str) -> Optional[float]:
+    """
+    Parse Anthropic's reset times (RFC 3339) into seconds from now.
+    """
+    try:
+        reset = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+
+
+def _parse_retry_after(headers: httpx.Headers) -> Optional[float]:
+    """
+    How many seconds a 429 asked us to wait. OpenAI sends `retry-after-ms`, and `retry-after` can be a number of
+    seconds or an HTTP date.
+    """
+    retry_after_ms = _float(headers.get('retry-after-ms'))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    seconds = _float(retry_after)
+    if seconds is not None:
+        return seconds
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _Bucket:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self._rolled_over = False
+
+    def update(self, limit: Optional[int], remaining: Optional[int], reset_in: Optional[float]):
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+        if reset_in is not None:
+            self.reset_at = time.monotonic() + reset_in
+            self._rolled_over = False
+
+    def _refresh(self, now: float):
+        if self.remaining is not None and now >= self.reset_at and not self._rolled_over:
+            # The window has reset since the provider last told us what was left. Requests that were held for this
+            # window already took their share of it (`remaining` went below zero).
+            self.remaining = None if self.limit is None else self.limit + min(0, self.remaining)
+            self._rolled_over = True
+
+    def available(self) -> Optional[int]:
+        self._refresh(time.monotonic())
+        return self.remaining
+
+    def reserve(self, amount: int) -> float:
+        """
+        Take `amount` from the bucket. Returns how long to wait first, if the bucket is empty until it resets.
+        """
+        now = time.monotonic()
+        self._refresh(now)
+        if self.remaining is None:
+            return 0
+        wait = 0
+        if self.remaining < amount and not self._rolled_over and (self.limit is None or amount <= self.limit):
+            # Take it out of the next window instead.
+            wait = self.reset_at - now
+        self.remaining -= amount
+        return wait
+
+
+class RateLimiter:
+    """
+    Tracks the rate limits of one API key from the headers in the provider's responses, and holds requests until
+    the provider says there is room for them instead of sending them into a 429. A request is held for at most
+    `rate_limit.max_wait` seconds.
+    """
+
+    def __init__(self):
+        self.requests = _Bucket()
+        self.tokens = _Bucket()
+        self.waited = 0
+        self.total_wait = 0.0
+        self.rate_limited = 0
+
+    async def acquire(self, tokens: int):
+        if not global_config['rate_limit']['enabled']:
+            return
+        # Reserving doesn't await so it can't interleave with other requests. Requests held for the same reset
+        # sleep at the same time instead of one after another.
+        wait = min(max(self.requests.reserve(1), self.tokens.reserve(tokens)), global_config['rate_limit']['max_wait'])
+        if wait > 0:
+            logger.debug(f'Holding request for {round(wait, 2)}s to stay under the rate limit')
+            self.waited += 1
+            self.total_wait += wait
+            await asyncio.sleep(wait)
+
+    def update(self, headers: httpx.Headers):
+        """
+        Read the rate limit headers from an OpenAI or Anthropic response.
+        """
+        if 'x-ratelimit-remaining-requests' in headers or 'x-ratelimit-remaining-tokens' in headers:
+            for kind, bucket in (('requests', self.requests), ('tokens', self.tokens)):
+                reset = headers.get(f'x-ratelimit-reset-{kind}')
+                bucket.update(
+                    _int(headers.get(f'x-ratelimit-limit-{kind}')),
+                    _int(headers.get(f'x-ratelimit-remaining-{kind}')),
+                    _parse_duration(reset) if reset else None
+                )
+        elif 'anthropic-ratelimit-requests-remaining' in headers or 'anthropic-ratelimit-tokens-remaining' in headers:
+            for kind, bucket in (('requests', self.requests), ('tokens', self.tokens)):
+                reset = headers.get(f'anthropic-ratelimit-{kind}-reset')
+                bucket.update(
+                    _int(headers.get(f'anthropic-ratelimit-{kind}-limit')),
+                    _int(headers.get(f'anthropic-ratelimit-{kind}-remaining')),
+                    _parse_timestamp(reset) if reset else None
+                )
+
+    @contextmanager
+    def observe_errors(self):
+        """
+        Read the rate limit headers from error responses too. On a 429, hold everything until it says to retry.
+        """
+        try:
+            yield
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            if isinstance(response, httpx.Response):
+                self.update(response.headers)
+                if response.status_code == 429:
+                    self.rate_limited += 1
+                    retry_after = _parse_retry_after(response.headers)
+                    if retry_after is not None:
+                        self.requests.update(None, 0, retry_after)
+            raise
+
+    def stats(self) -> dict:
+        return {
+            'requests_remaining': self.requests.available(),
+            'requests_limit': self.requests.limit,
+            'tokens_remaining': self.tokens.available(),
+            'tokens_limit': self.tokens.limit,
+            'waited': self.waited,
+            'total_wait': self.total_wait,
+            'rate_limited': self.rate_limited,
+        }
+
+
+class RateLimiters:
+    def __init__(self):
+        self._limiters: Dict[Tuple[str, str, str | None], RateLimiter] = {}
+
+    def get(self, api_type: str, api_key: str, api_base: str = None) -> RateLimiter:
+        key = (api_type, api_key, api_base)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = RateLimiter()
+        return limiter
+
+    def stats(self) -> dict:
+        # Only show the end of the API key.
+        return {
+            f'{api_type}:{api_base if api_base else "default"}:...{api_key[-4:] if api_key else ""}': limiter.stats()
+            for (api_type, api_key, api_base), limiter in self._limiters.items()
+        }
+
+
+rate_limiters = RateLimiters()
+metrics.register('rate_limits', rate_limiters.stats)
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from nio import Event, RoomMessageText
+from openai import AsyncOpenAI
+
+from matrix_gpt.api_client_manager import api_client_helper
+from matrix_gpt.config import global_config
+from matrix_gpt.metrics import metrics
+
+logger = logging.getLogger('MatrixGPT').getChild('Retrieval')
+
+
+class EmbeddingBackend:
+    """
+    Turns text into vectors. `embed()` returns one L2-normalized row per text.
+    """
+    name = None
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return (vectors / norms).astype(np.float32)
+
+
+class HashingEmbedding(EmbeddingBackend):
+    """
+    A local, deterministic embedding that hashes words and word pairs into a fixed number of buckets.
+    It doesn't understand meaning but needs no API and is good enough to find messages that share words.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.name = f'hashing-{dimensions}'
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        words = re.findall(r'\w+', text.lower())
+        for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+            h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+            vector[h % self.dimensions] += 1 if h >> 63 else -1
+        return vector
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return self._normalize(np.stack([self._embed_one(t) for t in texts]))
+
+
+class OpenAIEmbedding(EmbeddingBackend):
+    """
+    Embeddings from the OpenAI API, or any server compatible with it.
+    """
+
+    def __init__(self, model: str, api_base: str = None):
+        self.model = model
+        self.api_base = api_base
+        self.name = f'openai-{model}'
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        api_key = global_config['openai']['api_key']
+        client = api_client_helper.get_sdk_client(
+            'openai', api_key, self.api_base,
+            lambda http_client: AsyncOpenAI(api_key=api_key, base_url=self.api_base, http_client=http_client)
+        )
+        r = await client.embeddings.create(model=self.model, input=texts)
+        return self._normalize(np.array([d.embedding for d in sorted(r.data, key=lambda d: d.index)], dtype=np.float32))
+
+
+def create_backend() -> EmbeddingBackend:
+    config = global_config['retrieval']
+    if config['backend'] == 'openai':
+        return OpenAIEmbedding(config['model'], config['api_base'])
+    return HashingEmbedding(config['dimensions'])
+
+
+class ThreadIndex:
+    """
+    The embeddings of the messages in one thread.
+    """
+
+    def __init__(self, backend_name: str, event_ids: List[str] = None, vectors: np.ndarray = None):
+        self.backend_name = backend_name
+        self.event_ids = event_ids or []
+        self.vectors = vectors
+        self._positions = {event_id: i for i, event_id in enumerate(self.event_ids)}
+
+    def __contains__(self, event_id: str):
+        return event_id in self._positions
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def add(self, event_ids: List[str], vectors: np.ndarray):
+        for event_id in event_ids:
+            self._positions[event_id] = len(self.event_ids)
+            self.event_ids.append(event_id)
+        self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+
+    def search(self, query: np.ndarray, k: int, allowed: set) -> List[str]:
+        """
+        Get the IDs of the `k` events most similar to `query`, only considering the events in `allowed`.
+        """
+        if self.vectors is None or k < 1:
+            return []
+        scores = self.vectors @ query
+        mask = np.fromiter((event_id in allowed for event_id in self.event_ids), dtype=bool, count=len(self.event_ids))
+        scores[~mask] = -np.inf
+        k = min(k, int(mask.sum()))
+        if k < 1:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [self.event_ids[i] for i in top]
+
+    def dumps(self) -> bytes:
+        buf = io.BytesIO()
+        np.savez(buf, event_ids=np.array(self.event_ids), vectors=self.vectors, backend=np.array(self.backend_name))
+        return buf.getvalue()
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'ThreadIndex':
+        with np.load(io.BytesIO(data)) as f:
+            return cls(str(f['backend']), [str(e) for e in f['event_ids']], f['vectors'])
+
+
+class RetrievalMemory:
+    """
+    Picks which earlier messages of a long thread to send to the model. The thread's root and most recent messages are
+    always sent and the `retrieval.top_k` earlier messages most similar to the new message are added to them.
+    Each thread's embeddings are kept in memory (up to `retrieval.max_threads` threads) and saved to the store directory
+    so that nothing needs to be embedded again after a restart.
+    """
+
+    def __init__(self):
+        self._backend = None
+        self._indexes: OrderedDict[Tuple[str, str], ThreadIndex] = OrderedDict()
+        # Locks only live while a coroutine holds or waits on them, so evicting an index never replaces a lock in use.
+        self._locks: weakref.WeakValueDictionary[Tuple[str, str], asyncio.Lock] = weakref.WeakValueDictionary()
+        self._embedded = 0
+        self._searches = 0
+
+    @property
+    def _config(self):
+        return global_config['retrieval']
+
+    @property
+    def backend(self) -> EmbeddingBackend:
+        if self._backend is None:
+            self._backend = create_backend()
+        return self._backend
+
+    @property
+    def _disk_path(self) -> Path:
+        return Path(global_config['store_path']).absolute().expanduser().resolve() / 'retrieval'
+
+    def _index_file(self, key: Tuple[str, str]) -> Path:
+        return self._disk_path / (hashlib.sha256(f'{key[0]}:{key[1]}'.encode()).hexdigest() + '.npz')
+
+    async def select(self, room_id: str, thread_content: List[Event], query: str) -> List[Event]:
+        """
+        Get the events from `thread_content` to send to the model, in thread order.
+        """
+        keep_recent = self._config['keep_recent']
+        top_k = self._config['top_k']
+        if len(thread_content) <= 1 + keep_recent + top_k:
+            return thread_content
+
+        root, older, recent = thread_content[0], thread_content[1:-keep_recent], thread_content[-keep_recent:]
+        candidates = [e for e in older if isinstance(e, RoomMessageText)]
+        key = (room_id, root.event_id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        async with lock:
+            index = await self._get_index(key)
+            missing = [e for e in candidates if e.event_id not in index]
+            # Embed the new messages and the query in one request.
+            vectors = await self.backend.embed([e.body for e in missing] + [query])
+            if missing:
+                index.add([e.event_id for e in missing], vectors[:-1])
+                self._embedded += len(missing)
+                await self._save_index(key, index)
+        selected = set(index.search(vectors[-1], top_k, {e.event_id for e in candidates}))
+        self._searches += 1
+        return [root] + [e for e in older if e.event_id in selected] + recent
+
+    async def _get_index(self, key: Tuple[str, str]) -> ThreadIndex:
+        index = self._indexes.get(key)
+        if index is None:
+            index = await self._load_index(key)
+            if index is None or index.backend_name != self.backend.name:
+                index = ThreadIndex(self.backend.name)
+            self._indexes[key] = index
+        self._indexes.move_to_end(key)
+        while len(self._indexes) > self._config['max_threads']:
+            self._indexes.popitem(last=False)
+        return index
+
+    async def _load_index(self, key: Tuple[str, str]) -> ThreadIndex | None:
+        if not self._config['persist']:
+            return None
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, self._index_file(key).read_bytes)
+        except FileNotFoundError:
+            return None
+        try:
+            return ThreadIndex.loads(data)
+        except Exception as e:
+            logger.warning(f'Failed to load the retrieval index for thread {key[1]} in room {key[0]}: {e}')
+            return None
+
+    async def _save_index(self, key: Tuple[str, str], index: ThreadIndex):
+        if not self._config['persist']:
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self._write_file, self._index_file(key), index.dumps())
+
+    @staticmethod
+    def _write_file(path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        return {
+            'threads': len(self._indexes),
+            'vectors': sum(len(i) for i in self._indexes.values()),
+            'embedded': self._embedded,
+            'searches': self._searches,
+        }
+
+
+retrieval_memory = RetrievalMemory()
+metrics.register('retrieval', retrieval_memory.stats)
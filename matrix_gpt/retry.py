@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Optional
+
+from nio import ErrorResponse
+
+logger = logging.getLogger('MatrixGPT').getChild('Retry')
+
+
+def backoff_delay(attempt: int, base: float = 1, max_delay: float = 60, jitter: float = 0.25) -> float:
+    """
+    How long to wait before retry number `attempt` (starting at 0). The delay doubles with every attempt up to
+    `max_delay`, and a random `jitter` fraction is added or removed so that many clients don't retry at the same time.
+    """
+    delay = min(max_delay, base * 2 ** attempt)
+    return max(0.0, delay * (1 + random.uniform(-jitter, jitter)))
+
+
+def retry_after(response) -> Optional[float]:
+    """
+    The number of seconds the homeserver asked us to wait in an M_LIMIT_EXCEEDED error, if it gave one.
+    """
+    retry_after_ms = getattr(response, 'retry_after_ms', None)
+    if retry_after_ms:
+        return retry_after_ms / 1000
+    return None
+
+
+def retry_delay(attempt: int, base: float = 1, max_delay: float = 60, response=None) -> float:
+    """
+    How long to wait before retry number `attempt`, or as long as the homeserver asked if `response` is rate-limited.
+    """
+    delay = retry_after(response)
+    if delay is None:
+        delay = backoff_delay(attempt, base, max_delay)
+    return delay
+
+
+async def sleep_backoff(attempt: int, base: float = 1, max_delay: float = 60, response=None) -> float:
+    """
+    Sleep before retry number `attempt`. Returns the number of seconds slept.
+    """
+    delay = retry_delay(attempt, base, max_delay, response)
+    await asyncio.sleep(delay)
+    return delay
+
+
+async def retry_matrix(func: Callable[[], Awaitable], attempts: int = 3, base: float = 1, max_delay: float = 60, description: str = 'request'):
+    """
+    Call `func` until it returns something that isn't an `ErrorResponse`, up to `attempts` times.
+    Returns the last response.
+    """
+    response = None
+    for attempt in range(attempts):
+        response = await func()
+        if not isinstance(response, ErrorResponse):
+            return response
+        if attempt < attempts - 1:
+            delay = retry_delay(attempt, base, max_delay, response)
+            logger.warning(f'{description} failed (attempt {attempt + 1}): "{response.message}", retrying in {round(delay, 2)}s')
+            await asyncio.sleep(delay)
+    return response
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+
+from nio import MatrixRoom, Event, RoomSendResponse
+
+from matrix_gpt import MatrixClientHelper
+from matrix_gpt.config import global_config
+from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.metrics import metrics
+
+logger = logging.getLogger('MatrixGPT').getChild('Scheduler')
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class _ProviderQueue:
+    """
+    Limits the number of in-flight requests to one provider endpoint. Waiting requests are grouped by room and
+    rooms take turns getting a slot so that one busy room can't starve the others.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.queued = 0
+        self._rooms: OrderedDict[str, Deque[asyncio.Future]] = OrderedDict()
+
+    def try_acquire(self) -> bool:
+        if self.in_flight < self.limit and not self.queued:
+            self.in_flight += 1
+            return True
+        return False
+
+    def enqueue(self, room_id: str) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self._rooms.setdefault(room_id, deque()).append(future)
+        self.queued += 1
+        return future
+
+    def remove(self, room_id: str, future: asyncio.Future):
+        waiters = self._rooms.get(room_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._rooms[room_id]
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.in_flight < self.limit and self._rooms:
+            room_id, waiters = self._rooms.popitem(last=False)
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                # Move the room to the back of the line.
+                self._rooms[room_id] = waiters
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+
+class RequestScheduler:
+    """
+    Runs the bot's request handlers and controls how many requests can be sent to each provider at once.
+    Requests over the limit wait in a per-provider queue, which is signalled to the user with a reaction.
+    """
+
+    def __init__(self):
+        self._queues: Dict[tuple, _ProviderQueue] = {}
+        self._tasks = set()
+        self._waited = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._rejected = 0
+
+    def spawn(self, coro) -> asyncio.Task:
+        """
+        Run a request handler in the background. A reference to the task is kept until it finishes so it isn't garbage collected.
+        """
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(''.join(traceback.format_exception(task.exception())))
+
+    def _get_queue(self, command_info: CommandInfo) -> _ProviderQueue:
+        key = command_info.scheduler_key
+        queue = self._queues.get(key)
+        if queue is None:
+            # A pool of endpoints gets a slot limit for each endpoint.
+            queue = self._queues[key] = _ProviderQueue(global_config['scheduler']['max_in_flight'] * max(1, len(command_info.endpoints)))
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event, command_info: CommandInfo, react: bool = True):
+        """
+        Wait for a free slot for the provider this command uses. Raises `QueueFullError` if too many requests are already waiting.
+        Set `react` to False for background requests so the user isn't shown the queued reaction.
+        """
+        queue = self._get_queue(command_info)
+        if not queue.try_acquire():
+            if queue.queued >= global_config['scheduler']['max_queued']:
+                self._rejected += 1
+                raise QueueFullError(f'{queue.queued} requests are already queued for {command_info.api_type}')
+            await self._wait(queue, client_helper, room, event, react)
+        try:
+            yield
+        finally:
+            queue.release()
+
+    async def _wait(self, queue: _ProviderQueue, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event, react: bool = True):
+        start = time.monotonic()
+        future = queue.enqueue(room.room_id)
+        logger.debug(f'Queued event {event.event_id} in room {room.room_id} ({queue.queued} waiting)')
+        reaction_task = None
+        if react and global_config['scheduler']['queued_reaction']:
+            # Reactions wait behind the room's replies in the send queue. Don't make the slot wait for them too.
+            reaction_task = self.spawn(client_helper.react_to_event(room.room_id, event.event_id, global_config['scheduler']['queued_reaction']))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were given a slot right as we were cancelled.
+                queue.release()
+            else:
+                queue.remove(room.room_id, future)
+            raise
+        finally:
+            if reaction_task:
+                self.spawn(self._remove_reaction(client_helper, room, reaction_task))
+
+        waited = time.monotonic() - start
+        self._waited += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+        logger.debug(f'Event {event.event_id} waited {round(waited, 2)}s for a slot')
+
+    @staticmethod
+    async def _remove_reaction(client_helper: MatrixClientHelper, room: MatrixRoom, reaction_task: asyncio.Task):
+        try:
+            reaction = await reaction_task
+        except Exception:
+            # Already logged by _task_done().
+            return
+        if isinstance(reaction, RoomSendResponse):
+            await client_helper.redact_event(room.room_id, reaction.event_id)
+
+    def stats(self) -> dict:
+        return {
+            'tasks': len(self._tasks),
+            'queues': {
+                f'{api_type}:{",".join(api_base) if isinstance(api_base, tuple) else api_base if api_base else "default"}': {'in_flight': q.in_flight, 'queued': q.queued, 'limit': q.limit}
+                for (api_type, api_base), q in self._queues.items()
+            },
+            'waited': self._waited,
+            'avg_wait': self._total_wait / self._waited if self._waited else 0,
+            'max_wait': self._max_wait,
+            'rejected': self._rejected,
+        }
+
+
+request_scheduler = RequestScheduler()
+metrics.register('scheduler', request_scheduler.stats)
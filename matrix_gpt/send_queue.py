@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, List
+
+from nio import ErrorResponse
+
+from matrix_gpt.config import global_config
+from matrix_gpt.metrics import metrics
+from matrix_gpt.retry import retry_delay
+
+logger = logging.getLogger('MatrixGPT').getChild('SendQueue')
+
+# Replies and edits.
+PRIORITY_HIGH = 0
+# Reactions, read markers, and redactions.
+PRIORITY_LOW = 1
+
+
+def is_rate_limited(response) -> bool:
+    return isinstance(response, ErrorResponse) and response.status_code in ('M_LIMIT_EXCEEDED', 429)
+
+
+class SendQueue:
+    """
+    Sends the bot's events one at a time per room, in order. If the homeserver rate-limits us the event is retried
+    after the `retry_after_ms` it asked for, so replies aren't lost under load. Low-priority events (reactions,
+    read markers, redactions) wait until the room has no replies waiting.
+    """
+
+    def __init__(self):
+        self._queues: Dict[str, List] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._counter = itertools.count()
+        self._sent = 0
+        self._rate_limited = 0
+        self._failed = 0
+
+    async def send(self, room_id: str, func: Callable[[], Awaitable], priority: int = PRIORITY_HIGH):
+        """
+        Queue `func` (which sends one event) for this room and wait for its response.
+        """
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._queues.setdefault(room_id, []), (priority, next(self._counter), func, future))
+        if room_id not in self._workers:
+            self._workers[room_id] = asyncio.create_task(self._worker(room_id))
+        return await future
+
+    async def _worker(self, room_id: str):
+        queue = self._queues[room_id]
+        try:
+            while queue:
+                _, _, func, future = heapq.heappop(queue)
+                if future.done():
+                    # The caller stopped waiting.
+                    continue
+                try:
+                    response = await self._send_with_retry(room_id, func)
+                except Exception as e:
+                    self._failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(response)
+        finally:
+            del self._workers[room_id]
+            # Only has events left if the worker was cancelled.
+            for _, _, _, future in self._queues.pop(room_id):
+                future.cancel()
+
+    async def _send_with_retry(self, room_id: str, func: Callable[[], Awaitable]):
+        max_retries = global_config['send_queue']['max_retries']
+        attempt = 0
+        while True:
+            response = await func()
+            if not is_rate_limited(response) or attempt >= max_retries:
+                if isinstance(response, ErrorResponse):
+                    self._failed += 1
+                else:
+                    self._sent += 1
+                return response
+            self._rate_limited += 1
+            delay = retry_delay(attempt, base=1, max_delay=60, response=response)
+            logger.warning(f'Rate-limited sending to {room_id}, retrying in {round(delay, 2)}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> dict:
+        return {
+            'rooms': len(self._queues),
+            'queued': sum(len(q) for q in self._queues.values()),
+            'sent': self._sent,
+            'rate_limited': self._rate_limited,
+            'failed': self._failed,
+        }
+
+
+send_queue = SendQueue()
+metrics.register('send_queue', send_queue.stats)
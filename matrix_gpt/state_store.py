@@ -0,0 +1,129 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+logger = logging.getLogger('MatrixGPT').getChild('StateStore')
+
+
+class StateStore:
+    """
+    The bot's persistent state (login details, the sync token, and per-room state) in a JSON file.
+    The state is loaded once and kept in memory so reads never touch the disk. Changes are written in the background:
+    writes that happen close together are combined into one, and the file is replaced atomically (write to a temporary
+    file, fsync, rename) so a crash can't leave a half-written file behind.
+    """
+
+    def __init__(self, path: Path, write_delay: float = 1):
+        self.path = path
+        self.write_delay = write_delay
+        self._data = self._load()
+        self._dirty = False
+        self._write_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    def _load(self) -> dict:
+        data = {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            logger.error(f'State file {self.path} is corrupt, starting with an empty state: {e}')
+        data.setdefault('auth', {})
+        data.setdefault('extra', {})
+        data.setdefault('rooms', {})
+        return data
+
+    @property
+    def auth(self) -> dict:
+        return dict(self._data['auth'])
+
+    def set_auth(self, homeserver: str, user_id: str, device_id: str, access_token: str):
+        self._data['auth'] = {
+            'homeserver': homeserver,
+            'user_id': user_id,
+            'device_id': device_id,
+            'access_token': access_token,
+        }
+        self._changed()
+
+    @property
+    def sync_token(self) -> Optional[str]:
+        return self._data['extra'].get('last_sync')
+
+    @property
+    def sync_token_ts(self) -> Optional[int]:
+        """
+        When the sync token was received, in milliseconds.
+        """
+        return self._data['extra'].get('last_sync_ts')
+
+    def set_sync_token(self, token: str, ts: int = None):
+        """
+        Save the sync token and when it was received (`ts`, in milliseconds, defaults to now).
+        """
+        if token == self.sync_token:
+            return
+        self._data['extra']['last_sync'] = token
+        self._data['extra']['last_sync_ts'] = ts if ts is not None else int(time.time() * 1000)
+        self._changed()
+
+    def get_room_state(self, room_id: str, key: str, default: Any = None) -> Any:
+        return copy.deepcopy(self._data['rooms'].get(room_id, {}).get(key, default))
+
+    def set_room_state(self, room_id: str, key: str, value: Any):
+        """
+        Store a JSON-serializable value for a room.
+        """
+        self._data['rooms'].setdefault(room_id, {})[key] = copy.deepcopy(value)
+        self._changed()
+
+    def _changed(self):
+        self._dirty = True
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._delayed_write())
+
+    async def _delayed_write(self):
+        # Keep going until everything is written, changes made during a write aren't included in it.
+        while self._dirty:
+            await asyncio.sleep(self.write_delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Failed to write the state file {self.path}: {e}')
+
+    async def flush(self):
+        """
+        Write any pending changes to disk now.
+        """
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            serialized = json.dumps(self._data, indent=4)
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._write_file, serialized)
+            except Exception:
+                self._dirty = True
+                raise
+
+    def _write_file(self, serialized: str):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(serialized)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Make sure the rename itself is on disk.
+        dir_fd = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from nio import Event, MatrixRoom, RoomMessageText
+
+from matrix_gpt import MatrixClientHelper
+from matrix_gpt.api_client_manager import api_client_helper
+from matrix_gpt.chat_functions import check_command_prefix
+from matrix_gpt.config import global_config
+from matrix_gpt.endpoint_pool import endpoint_pools
+from matrix_gpt.generate_clients.command_info import CommandInfo
+from matrix_gpt.metrics import metrics
+from matrix_gpt.scheduler import request_scheduler
+
+logger = logging.getLogger('MatrixGPT').getChild('Summary')
+
+
+class ThreadSummaries:
+    """
+    Summarizes the start of long threads so that later replies only need to send the summary and the messages after it.
+    A summary checkpoint is stored in the `m.matrixgpt` block of the bot's next reply in the thread as `summary` and
+    `summary_until` (the last event the summary covers). Until that reply is sent the checkpoint is kept in memory.
+    """
+
+    def __init__(self):
+        self._unsaved: Dict[Tuple[str, str], dict] = {}
+        self._running = set()
+        self._created = 0
+        self._failed = 0
+
+    @property
+    def _config(self):
+        return global_config['summary']
+
+    def get_checkpoint(self, room_id: str, thread_content: List[Event], bot_user_id: str) -> Optional[Tuple[str, int]]:
+        """
+        Find the newest summary for this thread. Returns the summary and the index in `thread_content`
+        of the first event that isn't covered by it, or None if the thread hasn't been summarized.
+        """
+        key = (room_id, thread_content[0].event_id)
+        event_ids = [e.event_id for e in thread_content]
+        checkpoint = None
+        for event in reversed(thread_content):
+            if event.sender != bot_user_id:
+                continue
+            data = event.source.get('content', {}).get('m.matrixgpt', {})
+            if data.get('summary') and data.get('summary_until') in event_ids:
+                checkpoint = (data['summary'], event_ids.index(data['summary_until']) + 1)
+                break
+
+        unsaved = self._unsaved.get(key)
+        if unsaved and unsaved['summary_until'] in event_ids:
+            unsaved_start = event_ids.index(unsaved['summary_until']) + 1
+            if not checkpoint or unsaved_start > checkpoint[1]:
+                return unsaved['summary'], unsaved_start
+            # The checkpoint made it into the thread.
+            del self._unsaved[key]
+        return checkpoint
+
+    def get_unsaved(self, room_id: str, thread_root_id: str) -> dict:
+        """
+        Get the checkpoint that still needs to be attached to a reply in this thread.
+        """
+        return dict(self._unsaved.get((room_id, thread_root_id), {}))
+
+    def maybe_summarize(self, client_helper: MatrixClientHelper, room: MatrixRoom, event: Event, command_info: CommandInfo,
+                        thread_content: List[Event], checkpoint: Optional[Tuple[str, int]]):
+        """
+        Start summarizing the thread in the background if enough messages were sent since the last summary.
+        """
+        start = checkpoint[1] if checkpoint else 0
+        if len(thread_content) - start < self._config['threshold']:
+            return
+        key = (room.room_id, thread_content[0].event_id)
+        if key in self._running:
+            return
+        events = thread_content[start:len(thread_content) - self._config['keep_recent']]
+        if not events:
+            return
+        self._running.add(key)
+        request_scheduler.spawn(self._summarize(key, client_helper, room, event, command_info, checkpoint[0] if checkpoint else None, events))
+
+    async def _summarize(self, key: Tuple[str, str], client_helper: MatrixClientHelper, room: MatrixRoom, event: Event,
+                         command_info: CommandInfo, previous_summary: Optional[str], events: List[Event]):
+        try:
+            api_client = api_client_helper.get_client(command_info.api_type, client_helper, room, event, command_info)
+            if not api_client:
+                return
+
+            transcript = []
+            if previous_summary:
+                transcript.append(f'Summary of the earlier conversation:\n{previous_summary}\n')
+            for e in events:
+                if not isinstance(e, RoomMessageText):
+                    continue
+                msg = e.body.strip().strip('\n')
+                if e.sender != client_helper.client.user_id and check_command_prefix(msg)[0]:
+                    msg = msg[len(command_info.trigger):].strip()
+                transcript.append(f'{"Assistant" if e.sender == client_helper.client.user_id else "User"}: {msg}')
+
+            summary_info = command_info.replace(system_prompt=self._config['prompt'], injected_system_prompt=None, max_tokens=self._config['max_tokens'], stream=False)
+            api_client.assemble_context([api_client.generate_text_msg('\n\n'.join(transcript), api_client.HUMAN_NAME)], system_prompt=summary_info.system_prompt)
+
+            async with request_scheduler.slot(client_helper, room, event, command_info, react=False):
+                summary, _ = await asyncio.wait_for(endpoint_pools.call(summary_info, api_client.generate), timeout=global_config['response_timeout'])
+            if not summary:
+                logger.warning(f'Summary of thread {key[1]} in room {key[0]} was empty')
+                self._failed += 1
+                return
+
+            self._unsaved[key] = {'summary': summary.strip(), 'summary_until': events[-1].event_id}
+            self._created += 1
+            logger.debug(f'Summarized {len(events)} events in thread {key[1]} in room {key[0]}')
+        except Exception as e:
+            self._failed += 1
+            logger.warning(f'Failed to summarize thread {key[1]} in room {key[0]}: {e}')
+        finally:
+            self._running.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            'running': len(self._running),
+            'unsaved': len(self._unsaved),
+            'created': self._created,
+            'failed': self._failed,
+        }
+
+
+thread_summaries = ThreadSummaries()
+metrics.register('summary', thread_summaries.stats)
@@ -0,0 +1,163 @@
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Any
+
+from nio import Event, MegolmEvent
+
+from matrix_gpt.config import global_config
+
+logger = logging.getLogger('MatrixGPT').getChild('ThreadCache')
+
+
+def apply_edit(event: Event, edit_source: dict) -> None:
+    """
+    Replace the content of an event with the `m.new_content` of an edit made by the same sender.
+    """
+    new_content = edit_source.get('content', {}).get('m.new_content')
+    if not isinstance(new_content, dict) or edit_source.get('sender') != event.sender:
+        return
+    content = event.source.get('content', {}).copy()
+    content.update({k: v for k, v in new_content.items() if k != 'm.relates_to'})
+    event.source['content'] = content
+    if hasattr(event, 'body'):
+        event.body = new_content.get('body', event.body)
+    if hasattr(event, 'formatted_body'):
+        event.formatted_body = new_content.get('formatted_body')
+
+
+def apply_bundled_edit(event: Event) -> None:
+    """
+    Events fetched from the homeserver have their original content. Apply the latest edit if the server bundled it with the event.
+    """
+    edit = event.source.get('unsigned', {}).get('m.relations', {}).get('m.replace')
+    if isinstance(edit, dict) and 'content' in edit:
+        apply_edit(event, edit)
+
+
+class ThreadCache:
+    """
+    Keeps the events of recently active threads in memory so that building the context for a reply
+    doesn't need to fetch every message in the thread from the homeserver.
+    Threads are keyed by room ID + thread root event ID and evicted least-recently-used first
+    once the total number of cached events goes over `thread_cache.max_events`.
+    """
+
+    def __init__(self):
+        self._threads: OrderedDict[Tuple[str, str], Dict[str, Event]] = OrderedDict()
+        self._event_threads: Dict[Tuple[str, str], str] = {}
+        self._size = 0
+
+    @property
+    def max_events(self) -> int:
+        return global_config['thread_cache']['max_events']
+
+    def add_event(self, room_id: str, event: Event) -> None:
+        """
+        Add an event to the thread it belongs to. Events that are not part of a thread are stored as the root of their own thread.
+        """
+        if self.max_events < 1:
+            return
+        relates_to = event.source.get('content', {}).get('m.relates_to', {})
+        if relates_to.get('rel_type') == 'm.thread' and relates_to.get('event_id'):
+            thread_root_id = relates_to['event_id']
+        else:
+            thread_root_id = event.event_id
+        self._put(room_id, thread_root_id, event)
+
+    def get_event(self, room_id: str, thread_root_id: str, event_id: str) -> Optional[Event]:
+        key = (room_id, thread_root_id)
+        thread = self._threads.get(key)
+        if thread is None:
+            return None
+        self._threads.move_to_end(key)
+        return thread.get(event_id)
+
+    def put_event(self, room_id: str, thread_root_id: str, event: Event) -> None:
+        """
+        Store an event that was fetched from the homeserver while building a thread.
+        """
+        if self.max_events < 1:
+            return
+        self._put(room_id, thread_root_id, event)
+
+    def apply_edit(self, room_id: str, edit_event: Event) -> None:
+        """
+        Apply an `m.replace` edit to the cached event it targets, if we have it.
+        """
+        target_id = edit_event.source.get('content', {}).get('m.relates_to', {}).get('event_id')
+        thread_root_id = self._event_threads.get((room_id, target_id))
+        if not thread_root_id:
+            return
+        target = self._threads[(room_id, thread_root_id)].get(target_id)
+        if target:
+            apply_edit(target, edit_event.source)
+
+    def _put(self, room_id: str, thread_root_id: str, event: Event):
+        if isinstance(event, MegolmEvent):
+            # Don't keep events we couldn't decrypt, fetching them again later may work once we have the keys.
+            return
+        key = (room_id, thread_root_id)
+        thread = self._threads.get(key)
+        if thread is None:
+            thread = self._threads[key] = {}
+        self._threads.move_to_end(key)
+        if event.event_id not in thread:
+            self._size += 1
+        thread[event.event_id] = event
+        self._event_threads[(room_id, event.event_id)] = thread_root_id
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_events and len(self._threads) > 1:
+            key, thread = self._threads.popitem(last=False)
+            self._size -= len(thread)
+            for event_id in thread.keys():
+                self._event_threads.pop((key[0], event_id), None)
+            logger.debug(f'Evicted thread {key[1]} in room {key[0]} ({len(thread)} events)')
+
+    def __len__(self):
+        return self._size
+
+
+class ThreadCommandCache:
+    """
+    Maps thread root events to the command that started them so that `is_this_our_thread()` doesn't need to fetch
+    the root of every thread in the room. Threads that weren't started by a command are stored as None so that
+    we also remember which threads aren't ours.
+    """
+
+    def __init__(self):
+        self._roots: OrderedDict[Tuple[str, str], Any] = OrderedDict()
+
+    @property
+    def max_roots(self) -> int:
+        return global_config['thread_cache']['max_roots']
+
+    def get(self, room_id: str, thread_root_id: str) -> Tuple[bool, Any]:
+        """
+        Returns whether the root is cached and the command for it (None if the thread isn't ours).
+        """
+        key = (room_id, thread_root_id)
+        if key not in self._roots:
+            return False, None
+        self._roots.move_to_end(key)
+        return True, self._roots[key]
+
+    def put(self, room_id: str, thread_root_id: str, command_info) -> None:
+        if self.max_roots < 1:
+            return
+        key = (room_id, thread_root_id)
+        self._roots[key] = command_info
+        self._roots.move_to_end(key)
+        while len(self._roots) > self.max_roots:
+            self._roots.popitem(last=False)
+
+    def clear(self):
+        self._roots.clear()
+
+    def __len__(self):
+        return len(self._roots)
+
+
+thread_cache = ThreadCache()
+thread_command_cache = ThreadCommandCache()
@@ -0,0 +1,112 @@
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple
+
+import pytest
+from aiohttp import web
+from nio import AsyncClient
+
+ROOM_ID = '!room:localhost'
+BOT_USER_ID = '@bot:localhost'
+USER_ID = '@user:localhost'
+
+
+class FakeHomeserver:
+    """
+    A local stand-in for a homeserver that serves the endpoints used to fetch threads: single events and the
+    `m.thread` relations of a thread root. Set `relations_error` to a (status, body) tuple to act like a homeserver
+    without the relations API.
+    """
+
+    def __init__(self):
+        self.events: Dict[str, dict] = {}
+        self.relations_error: Tuple[int, dict] | None = None
+        self.requests: List[str] = []
+
+    def add_event(self, event_id: str, sender: str, body: str, ts: int, thread_root_id: str = None, reply_to: str = None) -> dict:
+        content = {'msgtype': 'm.text', 'body': body}
+        if thread_root_id:
+            content['m.relates_to'] = {
+                'rel_type': 'm.thread',
+                'event_id': thread_root_id,
+                'is_falling_back': True,
+                'm.in_reply_to': {'event_id': reply_to},
+            }
+        event = {
+            'type': 'm.room.message',
+            'event_id': event_id,
+            'room_id': ROOM_ID,
+            'sender': sender,
+            'origin_server_ts': ts,
+            'content': content,
+            'unsigned': {},
+        }
+        self.events[event_id] = event
+        return event
+
+    def add_thread(self, root_id: str, length: int, start_ts: int = 1000) -> List[dict]:
+        """
+        Add a thread root and `length` replies, alternating between the user and the bot, each replying to the last.
+        """
+        events = [self.add_event(root_id, USER_ID, '!c hello', start_ts)]
+        for i in range(length):
+            events.append(self.add_event(
+                f'{root_id}-{i}',
+                BOT_USER_ID if i % 2 == 0 else USER_ID,
+                f'message {i}',
+                start_ts + i + 1,
+                thread_root_id=root_id,
+                reply_to=events[-1]['event_id']
+            ))
+        return events
+
+    async def _get_event(self, request: web.Request) -> web.Response:
+        self.requests.append('event')
+        event = self.events.get(request.match_info['event_id'])
+        if event is None:
+            return web.json_response({'errcode': 'M_NOT_FOUND', 'error': 'Event not found'}, status=404)
+        return web.json_response(event)
+
+    async def _get_relations(self, request: web.Request) -> web.Response:
+        self.requests.append('relations')
+        if self.relations_error:
+            status, body = self.relations_error
+            return web.json_response(body, status=status)
+        root_id = request.match_info['event_id']
+        thread = sorted(
+            (e for e in self.events.values() if e['content'].get('m.relates_to', {}).get('event_id') == root_id),
+            key=lambda e: e['origin_server_ts']
+        )
+        start = int(request.query.get('from', 0))
+        limit = int(request.query.get('limit', 5))
+        data = {'chunk': thread[start:start + limit]}
+        if start + limit < len(thread):
+            data['next_batch'] = str(start + limit)
+        return web.json_response(data)
+
+    @asynccontextmanager
+    async def running(self):
+        """
+        Serve the homeserver on a local port and yield a client that is logged in to it.
+        """
+        app = web.Application()
+        for version in ('r0', 'v3'):
+            app.router.add_get(f'/_matrix/client/{version}/rooms/{{room_id}}/event/{{event_id}}', self._get_event)
+        app.router.add_get('/_matrix/client/v1/rooms/{room_id}/relations/{event_id}/m.thread', self._get_relations)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        client = AsyncClient(f'http://127.0.0.1:{port}', BOT_USER_ID)
+        client.access_token = 'token'
+        try:
+            yield client
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+
+@pytest.fixture
+def homeserver() -> FakeHomeserver:
+    return FakeHomeserver()
+
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+from nio import Event, MatrixRoom
+
+import matrix_gpt.thread_cache
+from conftest import BOT_USER_ID, ROOM_ID
+from matrix_gpt import chat_functions
+from matrix_gpt.chat_functions import get_thread_content, _get_thread_relations, _walk_thread_chain
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    config = {
+        'thread_fetch': {'mode': 'relations', 'batch_size': 3},
+        # Disable the thread cache so that every path has to ask the homeserver.
+        'thread_cache': {'max_events': 0, 'max_roots': 0},
+    }
+    monkeypatch.setattr(chat_functions, 'global_config', config)
+    monkeypatch.setattr(matrix_gpt.thread_cache, 'global_config', config)
+    monkeypatch.setattr(chat_functions, '_relations_supported', True)
+    return config
+
+
+def event_ids(events):
+    return [e.event_id for e in events]
+
+
+def test_relations_match_chain_walk(homeserver):
+    events = homeserver.add_thread('$root', 10)
+    # Sent after the message being replied to, so it isn't part of the context.
+    homeserver.add_event('$later', BOT_USER_ID, 'later', 5000, thread_root_id='$root', reply_to=events[-1]['event_id'])
+    room = MatrixRoom(ROOM_ID, BOT_USER_ID)
+    base_event = Event.parse_event(events[-1])
+
+    async def fetch():
+        async with homeserver.running() as client:
+            relations = await _get_thread_relations(client, room, '$root', base_event)
+            chain = await _walk_thread_chain(client, room, '$root', base_event)
+        return relations, chain
+
+    relations, chain = asyncio.run(fetch())
+    assert event_ids(relations) == event_ids(chain) == [e['event_id'] for e in events]
+    # 10 replies plus one more in batches of 3.
+    assert homeserver.requests.count('relations') == 4
+
+
+@pytest.mark.parametrize('status', [400, 404, 405])
+def test_falls_back_to_chain_walk(homeserver, status):
+    homeserver.relations_error = (status, {'errcode': 'M_UNRECOGNIZED', 'error': 'Unrecognized request'})
+    events = homeserver.add_thread('$root', 4)
+    room = MatrixRoom(ROOM_ID, BOT_USER_ID)
+    base_event = Event.parse_event(events[-1])
+
+    async def fetch():
+        async with homeserver.running() as client:
+            first = await get_thread_content(client, room, base_event)
+            second = await get_thread_content(client, room, base_event)
+        return first, second
+
+    first, second = asyncio.run(fetch())
+    assert event_ids(first) == event_ids(second) == [e['event_id'] for e in events]
+    # The relations API isn't tried again once we know it's unsupported.
+    assert homeserver.requests.count('relations') == 1
+    assert not chat_functions._relations_supported
+
+
+def test_other_errors_are_raised(homeserver):
+    homeserver.relations_error = (403, {'errcode': 'M_FORBIDDEN', 'error': 'Not in room'})
+    events = homeserver.add_thread('$root', 2)
+    room = MatrixRoom(ROOM_ID, BOT_USER_ID)
+
+    async def fetch():
+        async with homeserver.running() as client:
+            await _get_thread_relations(client, room, '$root', Event.parse_event(events[-1]))
+
+    with pytest.raises(Exception, match='403'):
+        asyncio.run(fetch())
+    assert chat_functions._relations_supported
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import openai
+import pytest
+
+from matrix_gpt import rate_limit
+from matrix_gpt.rate_limit import RateLimiter, _parse_duration, _parse_retry_after, _parse_timestamp
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    config = {'rate_limit': {'enabled': True, 'max_wait': 0.5}}
+    monkeypatch.setattr(rate_limit, 'global_config', config)
+    return config
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('1s', 1),
+    ('20ms', 0.02),
+    ('6m0s', 360),
+    ('1h2m3.5s', 3723.5),
+    ('0.5s', 0.5),
+])
+def test_parse_duration(value, seconds):
+    assert _parse_duration(value) == pytest.approx(seconds)
+
+
+def test_parse_duration_invalid():
+    assert _parse_duration('soon') is None
+
+
+def test_parse_timestamp():
+    reset = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert _parse_timestamp(reset.strftime('%Y-%m-%dT%H:%M:%SZ')) == pytest.approx(30, abs=1.5)
+    assert _parse_timestamp(reset.isoformat()) == pytest.approx(30, abs=1.5)
+    # Resets in the past mean there's nothing to wait for.
+    assert _parse_timestamp('2000-01-01T00:00:00Z') == 0
+    assert _parse_timestamp('not a date') is None
+
+
+def test_parse_retry_after():
+    assert _parse_retry_after(httpx.Headers({'retry-after-ms': '1500', 'retry-after': '2'})) == 1.5
+    assert _parse_retry_after(httpx.Headers({'retry-after': '7'})) == 7
+    assert _parse_retry_after(httpx.Headers({'retry-after': '0.25'})) == 0.25
+    retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=20), usegmt=True)
+    assert _parse_retry_after(httpx.Headers({'retry-after': retry_at})) == pytest.approx(20, abs=1.5)
+    assert _parse_retry_after(httpx.Headers({'retry-after': 'later'})) is None
+    assert _parse_retry_after(httpx.Headers()) is None
+
+
+def test_update_openai_headers():
+    limiter = RateLimiter()
+    limiter.update(httpx.Headers({
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '59',
+        'x-ratelimit-reset-requests': '1s',
+        'x-ratelimit-limit-tokens': '1000',
+        'x-ratelimit-remaining-tokens': '900',
+        'x-ratelimit-reset-tokens': '6m0s',
+    }))
+    stats = limiter.stats()
+    assert (stats['requests_limit'], stats['requests_remaining']) == (60, 59)
+    assert (stats['tokens_limit'], stats['tokens_remaining']) == (1000, 900)
+    assert limiter.tokens.reset_at - time.monotonic() == pytest.approx(360, abs=1)
+
+
+def test_update_anthropic_headers():
+    limiter = RateLimiter()
+    reset = (datetime.now(timezone.utc) + timedelta(seconds=10)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    limiter.update(httpx.Headers({
+        'anthropic-ratelimit-requests-limit': '50',
+        'anthropic-ratelimit-requests-remaining': '0',
+        'anthropic-ratelimit-requests-reset': reset,
+    }))
+    assert limiter.requests.remaining == 0
+    assert limiter.requests.reset_at - time.monotonic() == pytest.approx(10, abs=1.5)
+
+
+def test_acquire_holds_until_reset():
+    limiter = RateLimiter()
+    limiter.update(httpx.Headers({
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '0',
+        'x-ratelimit-reset-requests': '200ms',
+    }))
+    start = time.monotonic()
+    asyncio.run(limiter.acquire(10))
+    assert time.monotonic() - start == pytest.approx(0.2, abs=0.1)
+    # The window reset, so the request came out of a full bucket.
+    assert limiter.requests.available() == 59
+    assert limiter.stats()['waited'] == 1
+
+
+def test_held_requests_wait_together():
+    limiter = RateLimiter()
+    limiter.update(httpx.Headers({
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '0',
+        'x-ratelimit-reset-requests': '1h',
+    }))
+
+    async def acquire():
+        await limiter.acquire(1)
+        return time.monotonic() - start
+
+    async def run():
+        return await asyncio.gather(*(acquire() for _ in range(4)))
+
+    start = time.monotonic()
+    # Every request is held for at most `max_wait`, not behind the ones before it.
+    for waited in asyncio.run(run()):
+        assert waited == pytest.approx(0.5, abs=0.1)
+
+
+def test_acquire_waits_at_most_max_wait():
+    limiter = RateLimiter()
+    limiter.update(httpx.Headers({
+        'x-ratelimit-limit-tokens': '1000',
+        'x-ratelimit-remaining-tokens': '10',
+        'x-ratelimit-reset-tokens': '1h',
+    }))
+    start = time.monotonic()
+    asyncio.run(limiter.acquire(100))
+    assert time.monotonic() - start == pytest.approx(0.5, abs=0.1)
+
+
+def test_acquire_disabled(config):
+    config['rate_limit']['enabled'] = False
+    limiter = RateLimiter()
+    limiter.update(httpx.Headers({'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '1h'}))
+    start = time.monotonic()
+    asyncio.run(limiter.acquire(1))
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.parametrize('headers', [{'retry-after-ms': '3000'}, {'retry-after': '3'}])
+def test_429_blocks_the_key(headers):
+    limiter = RateLimiter()
+    response = httpx.Response(429, headers=headers, request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+    with pytest.raises(openai.RateLimitError):
+        with limiter.observe_errors():
+            raise openai.RateLimitError('Rate limit reached', response=response, body=None)
+    assert limiter.stats()['rate_limited'] == 1
+    assert limiter.requests.remaining == 0
+    assert limiter.requests.reset_at - time.monotonic() == pytest.approx(3, abs=0.5)
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from nio import Event
+
+from matrix_gpt import retrieval
+from matrix_gpt.retrieval import HashingEmbedding, RetrievalMemory, ThreadIndex
+
+ROOM_ID = '!room:localhost'
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch, tmp_path):
+    config = {
+        'store_path': str(tmp_path),
+        'retrieval': {
+            'backend': 'hashing',
+            'dimensions': 512,
+            'keep_recent': 2,
+            'top_k': 2,
+            'max_threads': 10,
+            'persist': True,
+        },
+    }
+    monkeypatch.setattr(retrieval, 'global_config', config)
+    return config
+
+
+def make_thread(bodies):
+    events = []
+    for i, body in enumerate(bodies):
+        content = {'msgtype': 'm.text', 'body': body}
+        if i:
+            content['m.relates_to'] = {'rel_type': 'm.thread', 'event_id': '$root', 'm.in_reply_to': {'event_id': events[-1].event_id}}
+        events.append(Event.parse_event({
+            'type': 'm.room.message',
+            'event_id': '$root' if not i else f'$event-{i}',
+            'sender': '@user:localhost',
+            'origin_server_ts': 1000 + i,
+            'content': content,
+        }))
+    return events
+
+
+THREAD = [
+    '!c let us talk',
+    'my favourite pizza topping is mushroom',
+    'the weather is cold and rainy today',
+    'I repaired the bicycle chain yesterday',
+    'pizza with extra cheese and mushroom is the best',
+    'the train was late again this morning',
+    'what should we cook tonight',
+    'something quick please',
+]
+
+
+def test_hashing_embedding_is_deterministic():
+    async def embed():
+        return await HashingEmbedding(128).embed(['hello world', 'hello world', 'something else'])
+
+    vectors = asyncio.run(embed())
+    assert vectors.shape == (3, 128)
+    assert (vectors[0] == vectors[1]).all()
+    assert vectors[0] @ vectors[0] == pytest.approx(1)
+    assert vectors[0] @ vectors[2] < 0.99
+
+
+def test_select_round_trip():
+    thread = make_thread(THREAD)
+
+    async def select(memory):
+        return await memory.select(ROOM_ID, thread, 'mushroom pizza')
+
+    memory = RetrievalMemory()
+    selected = asyncio.run(select(memory))
+    # The root, the two most similar earlier messages in thread order, then the recent messages.
+    assert [e.body for e in selected] == [THREAD[0], THREAD[1], THREAD[4], THREAD[6], THREAD[7]]
+    assert memory.stats()['embedded'] == 5
+
+    # A new instance loads the saved index instead of embedding everything again.
+    reloaded = RetrievalMemory()
+    assert [e.event_id for e in asyncio.run(select(reloaded))] == [e.event_id for e in selected]
+    assert reloaded.stats()['embedded'] == 0
+
+
+def test_index_dumps_and_loads():
+    async def embed():
+        return await HashingEmbedding(64).embed(['a b', 'c d'])
+
+    index = ThreadIndex('hashing-64')
+    index.add(['$a', '$b'], asyncio.run(embed()))
+    loaded = ThreadIndex.loads(index.dumps())
+    assert loaded.backend_name == 'hashing-64'
+    assert loaded.event_ids == ['$a', '$b']
+    assert (loaded.vectors == index.vectors).all()
+    assert '$b' in loaded
+
+
+def test_eviction_keeps_held_locks(config):
+    config['retrieval']['max_threads'] = 1
+    memory = RetrievalMemory()
+
+    async def run():
+        lock = memory._locks[(ROOM_ID, '$root')] = asyncio.Lock()
+        async with lock:
+            await memory._get_index((ROOM_ID, '$root'))
+            # Evicts the first thread's index while its lock is held.
+            await memory._get_index((ROOM_ID, '$other'))
+            assert memory._locks.get((ROOM_ID, '$root')) is lock
+
+    asyncio.run(run())
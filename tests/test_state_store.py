@@ -0,0 +1,47 @@
+import asyncio
+import json
+import time
+
+from matrix_gpt.state_store import StateStore
+
+
+def test_writes_are_combined(tmp_path):
+    path = tmp_path / 'state.json'
+
+    async def run():
+        store = StateStore(path, write_delay=0.05)
+        store.set_sync_token('a')
+        store.set_room_state('!room:localhost', 'key', {'value': 1})
+        await asyncio.sleep(0.2)
+        return store
+
+    store = asyncio.run(run())
+    data = json.loads(path.read_text())
+    assert data['extra']['last_sync'] == 'a'
+    assert data['rooms']['!room:localhost']['key'] == {'value': 1}
+    assert StateStore(path).get_room_state('!room:localhost', 'key') == {'value': 1}
+    assert not store._dirty
+
+
+def test_change_during_write_is_written(tmp_path):
+    path = tmp_path / 'state.json'
+
+    async def run():
+        store = StateStore(path, write_delay=0.05)
+        write_file = store._write_file
+
+        def slow_write(serialized):
+            time.sleep(0.2)
+            write_file(serialized)
+
+        store._write_file = slow_write
+        store.set_sync_token('a')
+        # Wait until the first write has started, then change the state while it is running.
+        await asyncio.sleep(0.1)
+        store.set_sync_token('b')
+        await asyncio.sleep(0.6)
+        return store
+
+    store = asyncio.run(run())
+    assert json.loads(path.read_text())['extra']['last_sync'] == 'b'
+    assert not store._dirty
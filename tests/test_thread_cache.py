@@ -0,0 +1,53 @@
+import pytest
+from nio import Event
+
+import matrix_gpt.thread_cache
+from matrix_gpt.thread_cache import ThreadCache
+
+ROOM_ID = '!room:localhost'
+
+
+@pytest.fixture(autouse=True)
+def config(monkeypatch):
+    config = {'thread_cache': {'max_events': 100, 'max_roots': 100}}
+    monkeypatch.setattr(matrix_gpt.thread_cache, 'global_config', config)
+    return config
+
+
+def thread_content(content: dict) -> dict:
+    content['m.relates_to'] = {'rel_type': 'm.thread', 'event_id': '$root', 'm.in_reply_to': {'event_id': '$root'}}
+    return content
+
+
+def test_caches_thread_events():
+    cache = ThreadCache()
+    event = Event.parse_event({
+        'type': 'm.room.message',
+        'event_id': '$reply',
+        'sender': '@user:localhost',
+        'origin_server_ts': 1000,
+        'content': thread_content({'msgtype': 'm.text', 'body': 'hello'}),
+    })
+    cache.add_event(ROOM_ID, event)
+    assert cache.get_event(ROOM_ID, '$root', '$reply') is event
+
+
+def test_does_not_cache_undecrypted_events():
+    cache = ThreadCache()
+    event = Event.parse_event({
+        'type': 'm.room.encrypted',
+        'event_id': '$encrypted',
+        'sender': '@user:localhost',
+        'origin_server_ts': 1000,
+        'content': thread_content({
+            'algorithm': 'm.megolm.v1.aes-sha2',
+            'ciphertext': 'ciphertext',
+            'device_id': 'DEVICE',
+            'sender_key': 'key',
+            'session_id': 'session',
+        }),
+    })
+    cache.add_event(ROOM_ID, event)
+    cache.put_event(ROOM_ID, '$root', event)
+    assert cache.get_event(ROOM_ID, '$root', '$encrypted') is None
+    assert len(cache) == 0